@@ -0,0 +1,85 @@
+#
+# AddressTable.py - cache of normalized SMS addresses
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+from collections import namedtuple
+import phonenumbers
+
+# an address in its different forms. The phone number formats are None if
+# the address could not be parsed as a phone number.
+Address = namedtuple('Address', 'raw e164 national international region')
+
+class AddressTable:
+	"""Normalizes SMS addresses, parsing each distinct address only once.
+	The table can be shared by everything that needs normalized addresses."""
+
+	def __init__(self, default_country):
+		self.default_country = default_country.upper()
+		self.table = {}
+		self.keys = {}		# address -> key(address)
+
+
+	def __len__(self):
+		return len(self.table)
+
+
+	def get(self, address):
+		"""Returns the Address for the given raw "address"."""
+
+		a = self.table.get(address)
+		if a is None:
+			a = self.table[address] = self._normalize(address)
+		return a
+
+
+	def key(self, address):
+		"""Returns the canonical form of an "address", used to compare
+		addresses written in different formats. This is the E.164 format for
+		phone numbers, otherwise the address without spaces."""
+
+		k = self.keys.get(address)
+		if k is None:
+			a = self.get(address)
+			k = self.keys[address] = a.e164 or address.replace(' ', '')
+		return k
+
+
+	def update_keys(self, keys):
+		"""Adds already known (address, key) pairs, so that key() does not 
+		need to normalize these addresses again."""
+
+		self.keys.update(keys)
+
+
+	def _normalize(self, address):
+		e164 = national = international = None
+		region = self.default_country
+		try:
+			pnumber = phonenumbers.parse(address, self.default_country)
+			e164 = phonenumbers.format_number(pnumber,
+								phonenumbers.PhoneNumberFormat.E164)
+			national = phonenumbers.format_number(pnumber,
+								phonenumbers.PhoneNumberFormat.NATIONAL)
+			international = phonenumbers.format_number(pnumber,
+								phonenumbers.PhoneNumberFormat.INTERNATIONAL)
+			region = phonenumbers.region_code_for_number(pnumber) or region
+		except:
+			pass
+
+		return Address(address, e164, national, international, region.lower())
+
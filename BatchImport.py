@@ -0,0 +1,180 @@
+#
+# BatchImport.py - runs many imports, as listed in a manifest
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os
+import csv
+import json
+import multiprocessing
+from sqlite3 import dbapi2 as sqlite
+
+from iPhoneSMSDB import iPhoneSMSDB, INSERT_BATCH_SIZE
+from NPSSource import open_NPS_source
+from AddressTable import AddressTable
+from ImportStats import ImportStats
+from SMSImporter import SMSImporter, parse_after_date
+
+# manifest columns; npsdb may list several databases separated by ";"
+MANIFEST_FIELDS = ['npsdb', 'smsdb', 'country', 'after_date', 'state_db']
+
+def read_manifest(path):
+	"""Reads the list of jobs from a JSON manifest (a list of objects) or a
+	CSV manifest with a header line. Each job is a dict with the keys in
+	MANIFEST_FIELDS; missing values are None."""
+
+	if os.path.splitext(path)[1].lower() == '.json':
+		f = open(path)
+		try:
+			entries = json.load(f)
+		finally:
+			f.close()
+	else:
+		f = open(path, 'rb')
+		try:
+			entries = [dict([(k.strip().lower(), v) for k, v in row.items() if k])
+					for row in csv.DictReader(f)]
+		finally:
+			f.close()
+
+	jobs = []
+	for entry in entries:
+		job = dict([(k, entry.get(k) or None) for k in MANIFEST_FIELDS])
+		if isinstance(job['npsdb'], basestring):
+			job['npsdb'] = [x.strip() for x in job['npsdb'].split(';') if x.strip()]
+		jobs.append(job)
+	return jobs
+
+
+def run_job(job):
+	"""Runs a single import job and commits it. Returns a dict with the job,
+	its counters and timings, and the error message if it failed.
+	Besides the manifest fields, the job may contain the options "dry_run",
+	"skip_ems", "full_sync", "bulk_dedup", "batch_size", "checkpoint", 
+	"skew", "max_memory", "pipeline", "defer_triggers" and "fast_import"."""
+
+	result = {'job': job, 'counts': None, 'elapsed': None, 'phases': None,
+			'error': None}
+	stats = ImportStats()
+	isms = None
+	try:
+		if not job.get('smsdb') or not job.get('country'):
+			raise ValueError('smsdb and country must be specified')
+
+		sources = [open_NPS_source(x, bool(job.get('max_memory'))) 
+				for x in job.get('npsdb') or [None]]
+		addresses = AddressTable(job['country'])
+		isms = iPhoneSMSDB(job['country'], job['smsdb'],
+				job.get('state_db') or job['smsdb'] + '-import.db', addresses,
+				in_memory=job.get('dry_run', False))
+		if job.get('fast_import'):
+			isms.begin_fast_import()
+
+		importer = SMSImporter(isms, sources, stats,
+				skip_ems=job.get('skip_ems', False),
+				after_date=parse_after_date(job.get('after_date')),
+				full_sync=job.get('full_sync', False),
+				bulk_dedup=job.get('bulk_dedup', False),
+				batch_size=job.get('batch_size') or INSERT_BATCH_SIZE,
+				checkpoint=job.get('checkpoint', 0),
+				dry_run=job.get('dry_run', False),
+				skew=job.get('skew', 0),
+				max_memory=job.get('max_memory'),
+				pipeline=job.get('pipeline', False),
+				defer_triggers=job.get('defer_triggers', False))
+		result['counts'] = importer.run()
+
+		if job.get('dry_run'):
+			isms.rollback()
+		else:
+			with stats.phase('commit'):
+				isms.commit()
+
+		if job.get('fast_import'):
+			problems = isms.end_fast_import()
+			if problems:
+				raise sqlite.DatabaseError('integrity check failed: ' + 
+						'; '.join(problems))
+	except Exception, err:
+		result['error'] = '%s: %s' % (err.__class__.__name__, err)
+	finally:
+		if isms:
+			isms.close()
+
+	stats.finish()
+	result['elapsed'] = round(stats.elapsed(), 6)
+	result['phases'] = stats.to_dict()['phases']
+	return result
+
+
+def run_batch(jobs, processes=None):
+	"""Runs the jobs concurrently in a pool of "processes" worker processes
+	(by default, one per CPU), yielding the result of each job as it
+	completes."""
+
+	if processes == 1:
+		for job in jobs:
+			yield run_job(job)
+		return
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		for result in pool.imap_unordered(run_job, jobs):
+			yield result
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+
+def batch_report(results, elapsed):
+	"""Returns the aggregated report of the batch as a dict."""
+
+	totals = {}
+	for r in results:
+		for k, v in (r['counts'] or {}).items():
+			totals[k] = totals.get(k, 0) + v
+
+	return {
+		'elapsed':	round(elapsed, 6),
+		'jobs':		len(results),
+		'failed':	len([r for r in results if r['error']]),
+		'totals':	totals,
+		'results':	results,
+		}
+
+
+def format_batch_report(report):
+	"""Returns a human-readable summary of a batch_report()."""
+
+	lines = ['%-30s %9s %9s %9s %9s  %s' %
+			('smsdb', 'inserted', 'duplicate', 'total', 'seconds', 'status')]
+	for r in report['results']:
+		counts = r['counts'] or {}
+		lines.append('%-30s %9d %9d %9d %9.2f  %s' % (r['job']['smsdb'],
+				counts.get('inserted', 0), counts.get('duplicate', 0),
+				counts.get('total', 0), r['elapsed'], r['error'] or 'ok'))
+
+	totals = report['totals']
+	lines.append('%-30s %9d %9d %9d %9.2f  %d of %d failed' % ('TOTAL',
+			totals.get('inserted', 0), totals.get('duplicate', 0),
+			totals.get('total', 0), report['elapsed'],
+			report['failed'], report['jobs']))
+	return '\n'.join(lines)
+
@@ -0,0 +1,357 @@
+#
+# ImportStats.py - timing and throughput statistics of an import
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import gc
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+# tracemalloc is used for memory profiling where available (Python 3.4+), 
+# otherwise the objects tracked by the garbage collector are counted
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+def peak_rss():
+	"""Returns the peak resident set size of this process in bytes, or None 
+	if it cannot be determined."""
+
+	try:
+		import resource
+	except ImportError:
+		resource = None
+
+	if resource:
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# in kilobytes, except on Mac OS X
+		return sys.platform == 'darwin' and rss or rss * 1024
+
+	# Windows
+	try:
+		import ctypes
+		from ctypes import wintypes
+
+		class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+			_fields_ = [
+				('cb',							wintypes.DWORD),
+				('PageFaultCount',				wintypes.DWORD),
+				('PeakWorkingSetSize',			ctypes.c_size_t),
+				('WorkingSetSize',				ctypes.c_size_t),
+				('QuotaPeakPagedPoolUsage',		ctypes.c_size_t),
+				('QuotaPagedPoolUsage',			ctypes.c_size_t),
+				('QuotaPeakNonPagedPoolUsage',	ctypes.c_size_t),
+				('QuotaNonPagedPoolUsage',		ctypes.c_size_t),
+				('PagefileUsage',				ctypes.c_size_t),
+				('PeakPagefileUsage',			ctypes.c_size_t),
+				]
+
+		counters = PROCESS_MEMORY_COUNTERS()
+		counters.cb = ctypes.sizeof(counters)
+		if ctypes.windll.psapi.GetProcessMemoryInfo(
+				ctypes.windll.kernel32.GetCurrentProcess(), 
+				ctypes.byref(counters), counters.cb):
+			return counters.PeakWorkingSetSize
+	except (ImportError, AttributeError, OSError):
+		pass
+
+	return None
+
+
+class Phase:
+	"""Accumulated statistics of one phase."""
+
+	def __init__(self, name):
+		self.name = name
+		self.seconds = 0.0
+		self.calls = 0
+		self.rows = 0
+
+	def rate(self):
+		"""Returns the number of rows processed per second."""
+		return self.seconds and self.rows / self.seconds or 0.0
+
+	def to_dict(self):
+		return {
+			'seconds':	round(self.seconds, 6),
+			'calls':	self.calls,
+			'rows':		self.rows,
+			'rows_per_second':	round(self.rate(), 1),
+			}
+
+
+class MemoryProfile:
+	"""Takes tracemalloc snapshots at points of interest of an import and 
+	keeps the top allocation sites of each of them. Without tracemalloc, 
+	the peak memory use of the process and the types with the most objects 
+	tracked by the garbage collector are kept instead."""
+
+	def __init__(self, limit=10):
+		self.limit = limit
+		self.snapshots = []	# (label, current, peak, top statistics)
+		self._counts = {}	# type name -> number of objects, at the last snapshot
+		if tracemalloc:
+			tracemalloc.start()
+
+
+	def snapshot(self, label):
+		if tracemalloc is None:
+			self.snapshots.append((label, None, peak_rss(), self._count_objects()))
+			return
+
+		snap = tracemalloc.take_snapshot().filter_traces((
+				tracemalloc.Filter(False, tracemalloc.__file__),))
+		current, peak = tracemalloc.get_traced_memory()
+		self.snapshots.append((label, current, peak, 
+				snap.statistics('lineno')[:self.limit]))
+
+
+	def _count_objects(self):
+		"""Returns the types with the most objects, and the change in their 
+		number since the last snapshot."""
+
+		counts = {}
+		for obj in gc.get_objects():
+			name = type(obj).__name__
+			counts[name] = counts.get(name, 0) + 1
+
+		top = sorted(counts.items(), key=lambda x: -x[1])[:self.limit]
+		top = ['%10d %+10d  %s' % (n, n - self._counts.get(name, 0), name) 
+				for name, n in top]
+		self._counts = counts
+		return top
+
+
+	def stop(self):
+		if tracemalloc:
+			tracemalloc.stop()
+
+
+	def report(self):
+		"""Returns a human-readable summary of the snapshots."""
+
+		lines = []
+		for label, current, peak, top in self.snapshots:
+			if current is not None:
+				lines.append('%s: %.1f KiB allocated, peak %.1f KiB' % 
+						(label, current / 1024.0, peak / 1024.0))
+			elif peak:
+				lines.append('%s: peak memory %.1f MiB, objects by type:' % 
+						(label, peak / 1048576.0))
+			else:
+				lines.append('%s: objects by type:' % label)
+			for stat in top:
+				lines.append('  %s' % stat)
+		return '\n'.join(lines)
+
+
+class ImportStats:
+	"""Measures the time spent in each phase of an import.
+	Phases may be nested; time spent in an inner phase is not counted in
+	the outer one, so the phase times add up to the time measured.
+	Phases may also be timed from several threads, in which case they 
+	overlap and add up to more than that."""
+
+	def __init__(self):
+		self.phases = {}
+		self.order = []
+		self.counters = {}
+		self.started = time.time()
+		self.finished = None
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self.memory = None	# MemoryProfile, if enabled
+		self.peak_rss = None
+		self.queues = {}	# name -> queue metrics of pipelined stages
+
+
+	@property
+	def _stack(self):
+		"""[phase, time entered or resumed] of the phases entered by the
+		current thread."""
+
+		stack = getattr(self._local, 'stack', None)
+		if stack is None:
+			stack = self._local.stack = []
+		return stack
+
+
+	def get(self, name):
+		"""Returns the Phase with the given name, creating it if needed."""
+
+		p = self.phases.get(name)
+		if p is None:
+			with self._lock:
+				p = self.phases.get(name)
+				if p is None:
+					p = self.phases[name] = Phase(name)
+					self.order.append(name)
+		return p
+
+
+	def enter(self, name):
+		now = time.time()
+		stack = self._stack
+		p = self.get(name)
+		with self._lock:
+			if stack:
+				outer = stack[-1]
+				outer[0].seconds += now - outer[1]
+			p.calls += 1
+		stack.append([p, now])
+
+
+	def leave(self, rows=0):
+		now = time.time()
+		stack = self._stack
+		p, entered = stack.pop()
+		with self._lock:
+			p.seconds += now - entered
+			p.rows += rows
+
+		# resume the outer phase
+		if stack:
+			stack[-1][1] = now
+
+
+	@contextmanager
+	def phase(self, name, rows=0):
+		"""Context manager timing the enclosed block as phase "name"."""
+
+		self.enter(name)
+		try:
+			yield
+		finally:
+			self.leave(rows)
+
+
+	def iterate(self, name, iterable):
+		"""Wraps "iterable", timing each item fetched from it as phase
+		"name"."""
+
+		it = iter(iterable)
+		while True:
+			self.enter(name)
+			try:
+				item = it.next()
+			except StopIteration:
+				self.leave()
+				return
+			except:
+				self.leave()
+				raise
+			self.leave(1)
+			yield item
+
+
+	def instrument(self, obj, method, name, rows=None):
+		"""Replaces "method" of "obj" with a wrapper timing its calls as phase
+		"name". If given, rows(*args) returns the number of rows processed
+		by a call, which otherwise counts as one row."""
+
+		func = getattr(obj, method)
+		def wrapper(*args, **kwargs):
+			self.enter(name)
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.leave(rows is None and 1 or rows(*args))
+
+		setattr(obj, method, wrapper)
+
+
+	def count(self, name, value):
+		"""Records an import counter, such as the number of SMSes inserted."""
+		self.counters[name] = value
+
+
+	def profile_memory(self, limit=10):
+		"""Enables memory snapshots, see snapshot()."""
+		self.memory = MemoryProfile(limit)
+
+
+	def snapshot(self, label):
+		"""Takes a memory snapshot labelled "label", if memory profiling was
+		enabled with profile_memory()."""
+
+		if self.memory:
+			self.memory.snapshot(label)
+
+
+	def finish(self):
+		self.finished = time.time()
+		self.peak_rss = peak_rss()
+		if self.memory:
+			self.memory.stop()
+
+
+	def elapsed(self):
+		return (self.finished or time.time()) - self.started
+
+
+	def to_dict(self):
+		return {
+			'started':	self.started,
+			'elapsed':	round(self.elapsed(), 6),
+			'counters':	self.counters,
+			'peak_rss':	self.peak_rss,
+			'queues':	self.queues,
+			'phases':	dict([(n, self.phases[n].to_dict()) for n in self.order]),
+			}
+
+
+	def write_json(self, path):
+		f = open(path, 'w')
+		try:
+			json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+		finally:
+			f.close()
+
+
+	def report(self):
+		"""Returns a human-readable summary of the phases."""
+
+		elapsed = self.elapsed()
+		lines = ['%-12s %10s %6s %10s %10s' %
+				('phase', 'seconds', '%', 'rows', 'rows/s')]
+		for n in self.order:
+			p = self.phases[n]
+			lines.append('%-12s %10.3f %6.1f %10d %10.1f' % (n, p.seconds,
+					elapsed and 100.0 * p.seconds / elapsed or 0.0,
+					p.rows, p.rate()))
+		other = elapsed - sum([p.seconds for p in self.phases.values()])
+		lines.append('%-12s %10.3f %6.1f' % ('(other)', other,
+				elapsed and 100.0 * other / elapsed or 0.0))
+		lines.append('%-12s %10.3f' % ('TOTAL', elapsed))
+		if self.peak_rss:
+			lines.append('peak memory: %.1f MiB' % (self.peak_rss / 1048576.0))
+
+		if self.queues:
+			lines.append('')
+			lines.append('%-12s %10s %10s %10s %10s %10s' % ('queue', 'items',
+					'max depth', 'mean depth', 'put wait', 'get wait'))
+			for n in sorted(self.queues):
+				q = self.queues[n]
+				lines.append('%-12s %10d %10d %10.1f %10.3f %10.3f' % (n, 
+						q['items'], q['max_depth'], q['mean_depth'], 
+						q['put_wait'], q['get_wait']))
+		return '\n'.join(lines)
+
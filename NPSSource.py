@@ -0,0 +1,367 @@
+#
+# NPSSource.py - Samsung New PC Studio (NPS) message sources
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os
+import csv
+import time
+import operator
+import heapq
+import tempfile
+from sqlite3 import dbapi2 as sqlite
+
+# number of rows fetched from the NPS database per call
+NPS_BLOCK_SIZE = 1000
+
+# ADO constants
+adOpenForwardOnly	= 0
+adLockReadOnly		= 1
+adUseServer			= 2
+
+# formats accepted for the Create_date column of exported data
+_DATE_FORMATS = [
+		'%Y-%m-%d %H:%M:%S',
+		'%Y-%m-%dT%H:%M:%S',
+		'%m/%d/%Y %H:%M:%S',
+		'%m/%d/%Y',
+		]
+
+def _parse_date(value):
+	"""Converts an exported Create_date value into a timestamp. Numbers are
+	taken as-is, strings are parsed as local time."""
+
+	if isinstance(value, (int, long, float)):
+		return int(value)
+
+	value = value.strip()
+	try:
+		return int(float(value))
+	except ValueError:
+		pass
+
+	for fmt in _DATE_FORMATS:
+		try:
+			return int(time.mktime(time.strptime(value, fmt)))
+		except ValueError:
+			pass
+
+	raise ValueError('unrecognized date: ' + value)
+
+
+class NPSSource(object):
+	"""Base class for sources of NPS messages.
+	Subclasses implement read(), which yields SMS dicts with the "address",
+	"text", "date" and "flags" keys, ordered by date."""
+
+	# columns of the MESSAGE table used by the importer, in order
+	columns = ['Sender', 'Receiver', 'Content', 'Create_date', 'Type']
+
+	def __init__(self, path):
+		self.path = path
+
+	def __repr__(self):
+		return '<%s %s>' % (self.__class__.__name__, self.path)
+
+	def fingerprint(self):
+		"""Returns a string identifying this source, used as the key of its
+		import watermark."""
+		return '%s:%s' % (self.__class__.__name__,
+				os.path.normcase(os.path.abspath(self.path)))
+
+	def read(self, skip_ems=False, after_date=None):
+		"""Yields SMSes from the source. If "skip_ems" is set, EMSes are not
+		returned. If "after_date" (a timestamp) is given, only SMSes created
+		on or after it are returned."""
+		raise NotImplementedError
+
+	def _date_literal(self, date):
+		return str(int(date))
+
+	def _build_query(self, skip_ems=False, after_date=None):
+		"""Returns the query for the MESSAGE table. Only the needed columns 
+		are selected, drafts and empty SMSes are filtered out and the rows 
+		are ordered by date, so that they can be consumed as a stream."""
+
+		filters = [
+			"Type IN (%s)" % ','.join(["'%s'" % t for t in self._types(skip_ems)]),
+			# SMSes with no address are likely drafts
+			"(Sender IS NOT NULL OR Receiver IS NOT NULL)",
+			# EMSes have no content, but get a placeholder text
+			"(Type = 'EMS' OR TRIM(Content) <> '')",
+			]
+		if after_date is not None:
+			filters.append("Create_date >= " + self._date_literal(after_date))
+
+		return "SELECT %s FROM MESSAGE WHERE %s ORDER BY Create_date" % (
+				', '.join(self.columns), ' AND '.join(filters))
+
+	@staticmethod
+	def _types(skip_ems):
+		return skip_ems and ['SMS'] or ['SMS', 'EMS']
+
+	@staticmethod
+	def _make_sms(sender, receiver, content, create_date, msg_type, flags=None):
+		"""Converts the columns of a MESSAGE row into an SMS dict.
+		Returns None for rows without an address."""
+
+		address = sender or receiver
+
+		# skip SMSes with no address - these are likely drafts
+		if address is None:
+			return None
+
+		# strip trailing semicolon
+		address = address.replace(';', '')
+
+		if flags is None:
+			flags = sender is not None and 2 or 3
+
+		s = {
+			'address':	address,
+			'text':		content,
+			'date':		int(create_date),
+			'flags':	flags,
+			}
+
+		if msg_type == 'EMS':
+			s['text'] = '<Imported EMS Placeholder>'
+
+		return s
+
+
+class JetNPSSource(NPSSource):
+	"""Reads the MESSAGE table of the NPS Guest.dat, using ADO and the Jet
+	OLEDB provider. Only available on Windows with pywin32."""
+
+	columns = NPSSource.columns + ['IIF(Sender IS NOT NULL, 2, 3) AS Flags']
+
+	def __init__(self, path=None, block_size=NPS_BLOCK_SIZE):
+		# locate NPS database
+		if not path:
+			from win32com.shell import shell, shellcon
+			appdata_dir = shell.SHGetFolderPath(0, shellcon.CSIDL_APPDATA, None, 0)
+			path = os.path.join(appdata_dir, 'Samsung', 'New PC Studio', 'Guest.dat')
+
+		NPSSource.__init__(self, path)
+		self.block_size = block_size
+
+	def read(self, skip_ems=False, after_date=None):
+		"""Reads SMSes from the Samsung New PC Studio (NPS) internal database.
+		Rows are fetched in blocks using a forward-only cursor instead of
+		loading the whole table up front."""
+
+		import win32com.client
+		import pythoncom
+
+		if not os.path.isfile(self.path):
+			raise IOError('unable to find Samsung NPS database at ' + self.path)
+
+		# COM must be initialized in each thread, see --pipeline
+		pythoncom.CoInitialize()
+		try:
+			adoconn = win32com.client.Dispatch(r'ADODB.Connection')
+			DSN = 'PROVIDER=Microsoft.Jet.OLEDB.4.0;DATA SOURCE=' + self.path
+			adoconn.Open(DSN)
+			rs = win32com.client.Dispatch(r'ADODB.Recordset')
+
+			rs.CursorLocation = adUseServer
+			nps_sql = self._build_query(skip_ems, after_date)
+			rs.Open(nps_sql, adoconn, adOpenForwardOnly, adLockReadOnly)
+
+			try:
+				while not rs.EOF:
+					# GetRows() returns a column-major array: one tuple per field
+					block = rs.GetRows(self.block_size)
+
+					for row in zip(*block):
+						s = self._make_sms(*row)
+						if s is not None:
+							yield s
+			finally:
+				rs.Close()
+				adoconn.Close()
+		finally:
+			pythoncom.CoUninitialize()
+
+	def _date_literal(self, date):
+		return time.strftime('#%m/%d/%Y %H:%M:%S#', time.localtime(date))
+
+
+class CSVNPSSource(NPSSource):
+	"""Reads an export of the NPS MESSAGE table as a UTF-8 CSV file.
+	The first line must contain the column names; empty fields are treated
+	as NULL. As CSV files cannot be queried, the SMSes are sorted in 
+	memory, or if "low_memory" is set, in a temporary SQLite database."""
+
+	def __init__(self, path, low_memory=False, block_size=NPS_BLOCK_SIZE):
+		NPSSource.__init__(self, path)
+		self.low_memory = low_memory
+		self.block_size = block_size
+
+	def read(self, skip_ems=False, after_date=None):
+		sms = self._read_unsorted(skip_ems, after_date)
+		if self.low_memory:
+			return self._sort_on_disk(sms)
+
+		sms = list(sms)
+		sms.sort(key=operator.itemgetter('date'))
+		return iter(sms)
+
+	def _sort_on_disk(self, sms):
+		fd, path = tempfile.mkstemp(suffix='.db', prefix='nps-')
+		os.close(fd)
+
+		db = sqlite.connect(path)
+		try:
+			db.execute('PRAGMA synchronous = OFF')
+			db.execute('CREATE TABLE sms (date INTEGER, address TEXT, ' + 
+					'text TEXT, flags INTEGER)')
+			db.executemany('INSERT INTO sms VALUES(?, ?, ?, ?)', 
+					((s['date'], s['address'], s['text'], s['flags']) for s in sms))
+			db.commit()
+
+			c = db.cursor()
+			c.execute('SELECT date, address, text, flags FROM sms ' + 
+					'ORDER BY date, ROWID')
+			while True:
+				rows = c.fetchmany(self.block_size)
+				if not rows:
+					break
+
+				for date, address, text, flags in rows:
+					yield {
+						'address':	address,
+						'text':		text,
+						'date':		date,
+						'flags':	flags,
+						}
+		finally:
+			db.close()
+			os.unlink(path)
+
+	def _read_unsorted(self, skip_ems, after_date):
+		types = self._types(skip_ems)
+
+		f = open(self.path, 'rb')
+		try:
+			reader = csv.reader(f)
+			header = [x.strip().lower() for x in reader.next()]
+			cols = [header.index(c.lower()) for c in self.columns]
+
+			for row in reader:
+				if not row:
+					continue
+
+				sender, receiver, content, create_date, msg_type = \
+					[row[i] and row[i].decode('utf-8') or None for i in cols]
+
+				# same filters as _build_query()
+				if msg_type not in types:
+					continue
+				if msg_type != 'EMS' and not (content and content.strip(' ')):
+					continue
+
+				create_date = _parse_date(create_date)
+				if after_date is not None and create_date < after_date:
+					continue
+
+				s = self._make_sms(sender, receiver, content, create_date, msg_type)
+				if s is not None:
+					yield s
+		finally:
+			f.close()
+
+
+class SQLiteNPSSource(NPSSource):
+	"""Reads an export of the NPS MESSAGE table stored in an SQLite
+	database. Create_date should hold timestamps or ISO 8601 dates, so that
+	rows can be ordered by it."""
+
+	def __init__(self, path, block_size=NPS_BLOCK_SIZE):
+		NPSSource.__init__(self, path)
+		self.block_size = block_size
+
+	def read(self, skip_ems=False, after_date=None):
+		if not os.path.isfile(self.path):
+			raise IOError('database doesn\'t exist: ' + self.path)
+
+		db = sqlite.connect(self.path)
+		try:
+			c = db.cursor()
+			c.execute(self._build_query(skip_ems, after_date))
+
+			while True:
+				rows = c.fetchmany(self.block_size)
+				if not rows:
+					break
+
+				for sender, receiver, content, create_date, msg_type in rows:
+					create_date = _parse_date(create_date)
+					if after_date is not None and create_date < after_date:
+						continue
+
+					s = self._make_sms(sender, receiver, content, create_date, msg_type)
+					if s is not None:
+						yield s
+		finally:
+			db.close()
+
+
+def open_NPS_source(path=None, low_memory=False):
+	"""Returns a NPSSource suitable for the given path, based on its file
+	extension. Guest.dat (or no path at all) is read through Jet.
+	If "low_memory" is set, sources that would load all SMSes into memory 
+	avoid doing so."""
+
+	ext = path and os.path.splitext(path)[1].lower() or None
+	if ext == '.csv':
+		return CSVNPSSource(path, low_memory)
+	elif ext in ('.db', '.sqlite', '.sqlite3'):
+		return SQLiteNPSSource(path)
+	return JetNPSSource(path)
+
+
+def merge_NPS_sms(streams, key=None):
+	"""Merges several SMS streams, each ordered by date, into a single stream 
+	ordered by date. Yields (index, sms, sms_key, duplicate) tuples, where 
+	"index" is the position of the stream the SMS came from and "sms_key" is 
+	key(sms), if "key" was given. "duplicate" is set if an SMS with the same 
+	date and key was already yielded, so that SMSes present in more than one 
+	stream are imported only once."""
+
+	def decorate(index, stream):
+		# the sequence number keeps SMSes themselves from being compared
+		for seq, s in enumerate(stream):
+			yield s['date'], index, seq, s
+
+	merged = heapq.merge(*[decorate(i, st) for i, st in enumerate(streams)])
+
+	current_date = None
+	seen = set()	# keys of the SMSes dated current_date
+	for date, index, seq, s in merged:
+		if key is None:
+			yield index, s, None, False
+			continue
+
+		if date != current_date:
+			current_date = date
+			seen.clear()
+
+		k = key(s)
+		yield index, s, k, k in seen
+		seen.add(k)
@@ -0,0 +1,143 @@
+#
+# Pipeline.py - runs stages of the import in threads, connected by queues
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import sys
+import time
+import threading
+import Queue
+
+# number of items passed through a queue at a time
+PIPELINE_CHUNK_SIZE = 200
+
+# number of chunks a queue holds before its producer has to wait
+PIPELINE_QUEUE_SIZE = 16
+
+_DONE = object()
+
+class StageStopped(Exception):
+	pass
+
+
+class Stage(threading.Thread):
+	"""Iterates over "iterable" in a thread of its own, passing the items to
+	the consumer iterating over the stage through a bounded queue. The
+	producer waits when the queue is full, so the slowest stage determines
+	the pace. Exceptions raised by "iterable" are re-raised in the
+	consumer."""
+
+	def __init__(self, name, iterable, queue_size=PIPELINE_QUEUE_SIZE,
+			chunk_size=PIPELINE_CHUNK_SIZE):
+		threading.Thread.__init__(self, name=name)
+		self.daemon = True
+
+		self.iterable = iterable
+		self.queue = Queue.Queue(queue_size)
+		self.chunk_size = chunk_size
+		self._stopped = False
+
+		self.items = 0
+		self.chunks = 0
+		self.max_depth = 0
+		self._depth_sum = 0
+		self._puts = 0
+		self.put_wait = 0.0		# time the producer waited for the consumer
+		self.get_wait = 0.0		# time the consumer waited for the producer
+
+
+	def _put(self, chunk):
+		depth = self.queue.qsize()
+		self.max_depth = max(self.max_depth, depth)
+		self._depth_sum += depth
+		self._puts += 1
+
+		started = time.time()
+		while True:
+			if self._stopped:
+				raise StageStopped()
+			try:
+				self.queue.put(chunk, True, 0.1)
+				break
+			except Queue.Full:
+				pass
+		self.put_wait += time.time() - started
+
+
+	def run(self):
+		try:
+			chunk = []
+			for item in self.iterable:
+				chunk.append(item)
+				if len(chunk) >= self.chunk_size:
+					self._put(chunk)
+					self.chunks += 1
+					chunk = []
+
+			if chunk:
+				self._put(chunk)
+				self.chunks += 1
+			self._put(_DONE)
+		except StageStopped:
+			pass
+		except:
+			try:
+				self._put(sys.exc_info())
+			except StageStopped:
+				pass
+
+
+	def __iter__(self):
+		while True:
+			started = time.time()
+			chunk = self.queue.get()
+			self.get_wait += time.time() - started
+
+			if chunk is _DONE:
+				return
+			if isinstance(chunk, tuple):
+				raise chunk[0], chunk[1], chunk[2]
+
+			self.items += len(chunk)
+			for item in chunk:
+				yield item
+
+
+	def stop(self):
+		"""Stops the producer, discarding the queued items."""
+
+		self._stopped = True
+		try:
+			while True:
+				self.queue.get_nowait()
+		except Queue.Empty:
+			pass
+		self.join()
+
+
+	def metrics(self):
+		"""Returns the queue statistics of the stage as a dict."""
+
+		return {
+			'items':		self.items,
+			'chunks':		self.chunks,
+			'max_depth':	self.max_depth,
+			'mean_depth':	round(self._puts and float(self._depth_sum) / self._puts or 0.0, 2),
+			'put_wait':		round(self.put_wait, 6),
+			'get_wait':		round(self.get_wait, 6),
+			}
+
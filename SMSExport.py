@@ -0,0 +1,79 @@
+#
+# SMSExport.py - streams the iPhone SMS database out as JSON lines or CSV
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os
+import csv
+import json
+
+# exported fields, in order
+EXPORT_FIELDS = ['rowid', 'date', 'address', 'e164', 'text', 'flags',
+		'group_id', 'group_address', 'country']
+
+def _encode(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+
+def write_jsonl(messages, f):
+	"""Writes each message as a JSON object on its own line."""
+
+	count = 0
+	for m in messages:
+		f.write(json.dumps(dict([(k, m[k]) for k in EXPORT_FIELDS]), sort_keys=True))
+		f.write('\n')
+		count += 1
+	return count
+
+
+def write_csv(messages, f):
+	"""Writes the messages as UTF-8 CSV, with a header line."""
+
+	writer = csv.writer(f)
+	writer.writerow(EXPORT_FIELDS)
+
+	count = 0
+	for m in messages:
+		writer.writerow([_encode(m[k]) for k in EXPORT_FIELDS])
+		count += 1
+	return count
+
+
+def export_sms(isms, path, stats=None):
+	"""Exports all SMSes of an iPhoneSMSDB to "path", as CSV if it ends in 
+	".csv", otherwise as JSON lines. SMSes are read and written as a stream, 
+	so memory use does not grow with the size of the database.
+	Returns the number of SMSes exported."""
+
+	messages = isms.iter_messages()
+	if stats:
+		messages = stats.iterate('read', messages)
+
+	if os.path.splitext(path)[1].lower() == '.csv':
+		f = open(path, 'wb')
+		write = write_csv
+	else:
+		f = open(path, 'w')
+		write = write_jsonl
+
+	try:
+		return write(messages, f)
+	finally:
+		f.close()
+
@@ -0,0 +1,419 @@
+#
+# SMSImporter.py - imports NPS SMSes into the iPhone SMS database
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import time
+import operator
+from collections import deque
+
+from iPhoneSMSDB import INSERT_BATCH_SIZE
+from NPSSource import merge_NPS_sms
+from ImportStats import ImportStats
+from Pipeline import Stage, PIPELINE_QUEUE_SIZE
+import ShardedImport
+
+def parse_after_date(date):
+	"""Converts an --after-date value (mm/dd/yyyy) to a timestamp.
+	Returns None if no date was given."""
+
+	if not date:
+		return None
+	return time.mktime(time.strptime(date, '%m/%d/%Y'))
+
+
+def instrument_import(stats, isms, addresses):
+	"""Times the calls made by an import to "isms" and "addresses" as the
+	phases of "stats": parse, dedup, groups and insert."""
+
+	stats.instrument(addresses, '_normalize', 'parse')
+	stats.instrument(isms, 'sms_exists', 'dedup')
+	stats.instrument(isms, 'load_fingerprints', 'dedup', lambda *a: 0)
+	stats.instrument(isms, 'get_group_id', 'groups')
+	stats.instrument(isms, 'add_group', 'groups')
+	stats.instrument(isms, 'insert_many', 'insert', lambda smses, *a: len(smses))
+
+
+class SkewWindow:
+	"""Finds existing SMSes dated within "skew" seconds of the imported ones,
+	with the same direction, address and text. The fingerprints of the 
+	existing SMSes must be ordered by date and match() must be called in 
+	date order, so both sides are merged in a single pass over a sliding 
+	window. Each existing SMS matches at most one imported SMS."""
+
+	def __init__(self, fingerprints, skew):
+		self.fingerprints = iter(fingerprints)
+		self.skew = skew
+		self.order = deque()	# (date, key) of the SMSes in the window
+		self.window = {}		# key -> deque of dates not yet matched
+		self._next = None
+
+
+	def _advance(self, high):
+		"""Adds the SMSes dated up to "high" to the window."""
+
+		while True:
+			if self._next is None:
+				self._next = next(self.fingerprints, None)
+				if self._next is None:
+					return
+			if self._next[0] > high:
+				return
+
+			date, key = self._next[0], self._next[1:]
+			self.order.append((date, key))
+			self.window.setdefault(key, deque()).append(date)
+			self._next = None
+
+
+	def _evict(self, low):
+		"""Drops the SMSes dated before "low" from the window."""
+
+		while self.order and self.order[0][0] < low:
+			date, key = self.order.popleft()
+			dates = self.window.get(key)
+			# unless it was matched already
+			if dates and dates[0] <= date:
+				dates.popleft()
+				if not dates:
+					del self.window[key]
+
+
+	def match(self, fp):
+		"""Returns True if an SMS matching the fingerprint "fp" exists."""
+
+		date = fp[0]
+		self._advance(date + self.skew)
+		self._evict(date - self.skew)
+
+		key = fp[1:]
+		dates = self.window.get(key)
+		if not dates:
+			return False
+
+		dates.popleft()
+		if not dates:
+			del self.window[key]
+		return True
+
+
+class SMSImporter:
+	"""Imports SMSes from one or more NPS sources into an iPhoneSMSDB.
+	run() can be called repeatedly, each time importing the SMSes added to
+	the sources since the previous run."""
+
+	def __init__(self, isms, sources, stats=None, verbose=0, skip_ems=False,
+			after_date=None, full_sync=False, bulk_dedup=False,
+			batch_size=INSERT_BATCH_SIZE, checkpoint=0, dry_run=False, skew=0,
+			max_memory=None, pipeline=False, queue_size=PIPELINE_QUEUE_SIZE,
+			shards=0, defer_triggers=False):
+		self.isms = isms
+		self.sources = sources
+		self.stats = stats or ImportStats()
+		self.verbose = verbose
+		self.skip_ems = skip_ems
+		self.after_date = after_date
+		self.full_sync = full_sync
+		self.bulk_dedup = bulk_dedup
+		self.batch_size = batch_size
+		self.checkpoint = checkpoint
+		self.dry_run = dry_run
+		self.skew = skew
+		self.max_memory = max_memory
+		self.pipeline = pipeline
+		self.queue_size = queue_size
+		self.shards = shards
+		self.defer_triggers = defer_triggers
+
+		if max_memory:
+			isms.limit_memory(max_memory)
+
+
+	def _insert_pending(self, pending):
+		"""Inserts the queued SMSes, returning the number of groups added."""
+
+		if not pending:
+			return 0
+
+		new_groups = self.isms.insert_many(pending, len(pending))
+		if self.verbose:
+			for address in new_groups:
+				print "added group for", address
+		return len(new_groups)
+
+
+	def _stop_stages(self, stages):
+		"""Stops the pipeline stages, downstream first, and records their 
+		queue statistics."""
+
+		for stage in reversed(stages):
+			stage.stop()
+			self.stats.queues[stage.name] = stage.metrics()
+
+
+	def _begin_bulk_load(self):
+		if not self.isms.begin_bulk_load():
+			print "warning: sms.db has unknown triggers on new SMSes, " + \
+					"they are not deferred"
+			self.defer_triggers = False
+
+
+	def _after_dates(self, source_ids, watermarks):
+		"""Returns the date to read each source from."""
+
+		after_dates = []
+		for source, source_id, watermark in zip(self.sources, source_ids, watermarks):
+			source_after = self.after_date
+			progress = self.isms.get_progress(source_id)
+			if progress:
+				# resume an interrupted import
+				source_after = progress[0]
+				print "resuming import from", source.path, "after", \
+						progress[1], "SMSes"
+			elif source_after is None and watermark is not None and not self.full_sync:
+				source_after = watermark
+				if self.verbose: print "importing SMSes from", source.path, \
+						"after", time.ctime(watermark)
+			after_dates.append(source_after)
+
+		return after_dates
+
+
+	def run(self):
+		"""Imports the SMSes, returning a dict of counters. Changes are left
+		uncommitted, except for those committed at checkpoints."""
+
+		isms = self.isms
+		stats = self.stats
+
+		# continue from the newest SMS imported by a previous run of each source
+		source_ids = [x.fingerprint() for x in self.sources]
+		watermarks = [isms.get_watermark(x) for x in source_ids]
+		newest_dates = watermarks[:]
+		after_dates = self._after_dates(source_ids, watermarks)
+
+		streams = [stats.iterate('read', x.read(self.skip_ems, d))
+				for x, d in zip(self.sources, after_dates)]
+
+		if self.shards:
+			counts = self._run_sharded(streams, newest_dates)
+			self._update_watermarks(source_ids, watermarks, newest_dates)
+			return self._count(counts)
+
+		# pipelined, each source is read by a thread of its own, and another 
+		# merges and normalizes the SMSes, while this thread owns the database
+		stages = []
+		if self.pipeline:
+			streams = [Stage('read:%d' % i, x, self.queue_size) 
+					for i, x in enumerate(streams)]
+			stages = streams[:]
+
+		# merge all sources by date, dropping SMSes found in several of them
+		nps_sms = merge_NPS_sms(streams, isms.sms_fingerprint)
+
+		if self.pipeline:
+			nps_sms = Stage('normalize', nps_sms, self.queue_size)
+			stages.append(nps_sms)
+			for stage in stages:
+				stage.start()
+
+		# fingerprints of SMSes queued for insertion and, for bulk_dedup,
+		# of the existing SMSes
+		fingerprints = set()
+
+		# with a skew, or when memory is limited, existing SMSes are merged 
+		# in by date instead of being loaded
+		window = None
+		if self.skew or self.max_memory:
+			min_date = None
+			if None not in after_dates:
+				min_date = min(after_dates) - self.skew
+			window = SkewWindow(stats.iterate('dedup', 
+					isms.iter_fingerprints(min_date, ordered=True)), self.skew)
+		elif self.bulk_dedup:
+			fingerprints = isms.load_fingerprints(
+					None if None in after_dates else min(after_dates))
+			if self.verbose: print "loaded", len(fingerprints), "existing SMSes"
+			stats.snapshot('existing SMSes loaded')
+		else:
+			with stats.phase('dedup'):
+				isms.create_dedup_index()
+
+		pending = []
+
+		# each checkpoint is a savepoint, which commits when released, unless
+		# this is a dry run
+		checkpoint = self.checkpoint
+		last_dates = after_dates[:]
+		if checkpoint:
+			if self.dry_run:
+				isms.begin()
+			isms.savepoint('checkpoint')
+
+		# the triggers are restored when committing
+		if self.defer_triggers:
+			self._begin_bulk_load()
+
+		count_total		= 0
+		count_dup		= 0
+		count_inserted	= 0
+		count_newgrp	= 0
+
+		stats.enter('process')
+		try:
+			for i, s, fp, merged_dup in nps_sms:
+				newest_dates[i] = max(newest_dates[i], s['date'])
+				last_dates[i] = s['date']
+
+				# empty SMSes are skipped by the sources, except for those the
+				# source query cannot tell, such as tabs or line breaks only, 
+				# and like them are not counted
+				if not s['text'] or not s['text'].strip():
+					if self.verbose >= 2: print "skipping empty SMS", s
+					continue
+
+				count_total += 1
+				# queued SMSes are not in the database yet, so check them separately
+				if merged_dup or fp in fingerprints or \
+						(window is not None and window.match(fp)) or \
+						(window is None and not self.bulk_dedup and isms.sms_exists(s)):
+					if self.verbose >= 2: print "duplicate SMS", s
+					count_dup += 1
+				else:
+					if self.verbose: print "inserting SMS", s
+					fingerprints.add(fp)
+					pending.append(s)
+					count_inserted += 1
+
+					if len(pending) >= self.batch_size:
+						count_newgrp += self._insert_pending(pending)
+						pending = []
+
+						# duplicates of the inserted SMSes have the same date, 
+						# so merge_NPS_sms() flags them from now on
+						if window is not None:
+							fingerprints.clear()
+
+				if checkpoint and count_total % checkpoint == 0:
+					count_newgrp += self._insert_pending(pending)
+					pending = []
+					for source_id, last_date in zip(source_ids, last_dates):
+						isms.set_progress(source_id, last_date, count_total)
+					isms.release('checkpoint')
+					isms.savepoint('checkpoint')
+					if self.verbose: print "checkpoint after", count_total, "SMSes"
+
+			count_newgrp += self._insert_pending(pending)
+		except:
+			stats.leave(count_total)
+			self._stop_stages(stages)
+
+			# keep the work up to the last checkpoint
+			if checkpoint:
+				isms.rollback_to('checkpoint')
+				isms.release('checkpoint')
+				print
+				print "import interrupted, run again to resume from the last checkpoint"
+			raise
+		stats.leave(count_total)
+		self._stop_stages(stages)
+		stats.snapshot('SMSes read, deduplicated and inserted')
+
+		self._update_watermarks(source_ids, watermarks, newest_dates)
+
+		if checkpoint:
+			isms.release('checkpoint')
+
+		return self._count({
+			'new_groups':	count_newgrp,
+			'duplicate':	count_dup,
+			'inserted':		count_inserted,
+			'total':		count_total,
+			})
+
+
+	def _update_watermarks(self, source_ids, watermarks, newest_dates):
+		isms = self.isms
+		for source_id, watermark, newest_date in zip(source_ids, watermarks, newest_dates):
+			if newest_date != watermark:
+				isms.set_watermark(source_id, newest_date)
+			if isms.get_progress(source_id):
+				isms.clear_progress(source_id)
+
+
+	def _count(self, counts):
+		"""Adds the counters of a run to the statistics, and returns them."""
+
+		for k, v in counts.items():
+			self.stats.count(k, self.stats.counters.get(k, 0) + v)
+		return counts
+
+
+	def _run_sharded(self, streams, newest_dates):
+		"""Imports the SMSes with the decisions made by the worker processes 
+		of ShardedImport, each deduplicating the SMSes of some of the 
+		addresses against sms.db. The groups are added and the SMSes inserted
+		here, in date order."""
+
+		isms = self.isms
+		stats = self.stats
+
+		if self.defer_triggers:
+			self._begin_bulk_load()
+
+		def numbered():
+			for seq, (i, s, k, dup) in enumerate(merge_NPS_sms(streams)):
+				newest_dates[i] = max(newest_dates[i], s['date'])
+				yield seq, s
+
+		plan = []
+		with stats.phase('plan'):
+			for shard_plan in ShardedImport.plan_sharded(isms.path, 
+					isms.default_country, numbered(), self.shards):
+				plan.extend(shard_plan)
+		plan.sort(key=operator.itemgetter(0))
+
+		counts = {'new_groups': 0, 'duplicate': 0, 'inserted': 0, 
+				'total': len(plan)}
+		new_groups = {}		# canonical address -> group_id
+		rows = []
+		for seq, decision, row in plan:
+			counts[decision == ShardedImport.INSERT and 'inserted' or decision] += 1
+			if decision != ShardedImport.INSERT:
+				continue
+
+			row, key = row
+			if row[4] is None:
+				group_id = new_groups.get(key)
+				if group_id is None:
+					group_id = new_groups[key] = isms.add_group(row[0])
+					counts['new_groups'] += 1
+					if self.verbose: print "added group for", row[0]
+				row = row[:4] + (group_id,) + row[5:]
+
+			rows.append(row)
+			if len(rows) >= self.batch_size:
+				with stats.phase('insert', len(rows)):
+					isms.insert_rows(rows)
+				rows = []
+
+		if rows:
+			with stats.phase('insert', len(rows)):
+				isms.insert_rows(rows)
+
+		return counts
+
@@ -0,0 +1,124 @@
+#
+# ShardedImport.py - deduplicates SMSes in worker processes, by address
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import zlib
+import multiprocessing
+
+from iPhoneSMSDB import iPhoneSMSDB
+
+# number of shards per worker process, so that a shard holding a busy
+# conversation does not leave the other workers idle
+SHARDS_PER_PROCESS = 4
+
+# number of trailing digits identifying a phone number in any format
+_SHARD_DIGITS = 8
+
+# decisions made for each SMS
+DUPLICATE, INSERT = 'duplicate', 'insert'
+
+def shard_key(address):
+	"""Returns the part of an address used to assign it to a shard. This is
+	cheaper than normalizing the address, but equal for the different
+	formats of a phone number, as they end with the same digits."""
+
+	key = ''.join([c for c in address if c.isdigit()])[-_SHARD_DIGITS:] or \
+			address.replace(' ', '').lower()
+	if isinstance(key, unicode):
+		key = key.encode('utf-8')
+	return key
+
+
+def shard_of(address, shards):
+	return (zlib.crc32(shard_key(address)) & 0xffffffff) % shards
+
+
+def plan_shard(task):
+	"""Decides what to do with each SMS of a shard, given as a (sms_db,
+	country, smses) tuple, where "smses" is a list of (seq, sms) ordered
+	by date. Existing SMSes are read from "sms_db", which is not modified.
+	Returns a list of (seq, decision, row) tuples, leaving out empty SMSes.
+	For SMSes to insert, "row" is the (address, date, text, flags, group_id,
+	country) tuple to insert and the canonical address; group_id is None if
+	the group doesn't exist yet."""
+
+	sms_db, country, smses = task
+
+	isms = iPhoneSMSDB(country, sms_db)
+	try:
+		groups = {}			# canonical address -> group_id
+		fingerprints = {}	# canonical address -> fingerprints of its SMSes
+		plan = []
+
+		for seq, s in smses:
+			if not s['text'] or not s['text'].strip():
+				continue
+
+			key = isms.address_key(s['address'])
+			if key not in groups:
+				group_id = groups[key] = isms.get_group_id(s['address'])
+				fingerprints[key] = set()
+				if group_id is not None:
+					fingerprints[key].update(isms.iter_fingerprints(group_id=group_id))
+
+			# this also catches SMSes found in more than one NPS database
+			fp = isms.sms_fingerprint(s, key)
+			if fp in fingerprints[key]:
+				plan.append((seq, DUPLICATE, None))
+				continue
+
+			fingerprints[key].add(fp)
+			plan.append((seq, INSERT, ((s['address'], s['date'], s['text'],
+					s['flags'], groups[key],
+					isms.addresses.get(s['address']).region), key)))
+
+		return plan
+	finally:
+		isms.close()
+
+
+def plan_sharded(sms_db, country, smses, processes=None):
+	"""Partitions the SMSes, an iterable of (seq, sms) ordered by date, by
+	address and plans each partition with plan_shard() in a pool of
+	"processes" worker processes (by default, one per CPU). Yields the plan
+	of each shard as it completes."""
+
+	processes = processes or multiprocessing.cpu_count()
+	shards = processes * SHARDS_PER_PROCESS
+
+	partitions = [[] for i in range(shards)]
+	for seq, s in smses:
+		partitions[shard_of(s['address'], shards)].append((seq, s))
+
+	tasks = [(sms_db, country, p) for p in partitions if p]
+	if processes == 1:
+		for task in tasks:
+			yield plan_shard(task)
+		return
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		for plan in pool.imap_unordered(plan_shard, tasks):
+			yield plan
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
@@ -0,0 +1,190 @@
+#
+# SyntheticData.py - generates NPS and iPhone SMS databases for benchmarks
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os
+import random
+import bisect
+from sqlite3 import dbapi2 as sqlite
+
+from iPhoneSMSDB import iPhoneSMSDB
+from NPSSource import NPSSource
+
+# tables, indexes and triggers of the iPhone (iOS 4) sms.db used by the importer
+SMS_DB_SCHEMA = """
+CREATE TABLE _SqliteDatabaseProperties (key TEXT, value TEXT, UNIQUE(key));
+CREATE TABLE message (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, address TEXT,
+	date INTEGER, text TEXT, flags INTEGER, replace INTEGER, svc_center TEXT,
+	group_id INTEGER, association_id INTEGER, height INTEGER, UIFlags INTEGER,
+	version INTEGER, subject TEXT, country TEXT, headers BLOB, recipients BLOB,
+	read INTEGER);
+CREATE TABLE msg_group (ROWID INTEGER PRIMARY KEY AUTOINCREMENT, type INTEGER,
+	newest_message INTEGER, unread_count INTEGER, hash INTEGER);
+CREATE TABLE group_member (ROWID INTEGER PRIMARY KEY AUTOINCREMENT,
+	group_id INTEGER, address TEXT, country TEXT);
+CREATE INDEX message_group_index ON message(group_id, ROWID);
+CREATE INDEX message_flags_index ON message(flags);
+CREATE TRIGGER insert_unread_message AFTER INSERT ON message
+	WHEN NOT read(new.flags) BEGIN
+	UPDATE msg_group SET unread_count = (SELECT unread_count FROM msg_group
+		WHERE ROWID = new.group_id) + 1 WHERE ROWID = new.group_id; END;
+CREATE TRIGGER mark_message_unread AFTER UPDATE ON message
+	WHEN read(old.flags) AND NOT read(new.flags) BEGIN
+	UPDATE msg_group SET unread_count = (SELECT unread_count FROM msg_group
+		WHERE ROWID = new.group_id) + 1 WHERE ROWID = new.group_id; END;
+CREATE TRIGGER mark_message_read AFTER UPDATE ON message
+	WHEN NOT read(old.flags) AND read(new.flags) BEGIN
+	UPDATE msg_group SET unread_count = (SELECT unread_count FROM msg_group
+		WHERE ROWID = new.group_id) - 1 WHERE ROWID = new.group_id; END;
+CREATE TRIGGER delete_message AFTER DELETE ON message
+	WHEN NOT read(old.flags) BEGIN
+	UPDATE msg_group SET unread_count = (SELECT unread_count FROM msg_group
+		WHERE ROWID = old.group_id) - 1 WHERE ROWID = old.group_id; END;
+CREATE TRIGGER insert_newest_message AFTER INSERT ON message
+	WHEN new.ROWID >= IFNULL((SELECT MAX(ROWID) FROM message
+		WHERE message.group_id = new.group_id), 0) BEGIN
+	UPDATE msg_group SET newest_message = new.ROWID
+		WHERE ROWID = new.group_id; END;
+CREATE TRIGGER delete_newest_message AFTER DELETE ON message
+	WHEN old.ROWID = (SELECT newest_message FROM msg_group
+		WHERE ROWID = old.group_id) BEGIN
+	UPDATE msg_group SET newest_message = (SELECT ROWID FROM message
+		WHERE group_id = old.group_id AND ROWID = (SELECT max(ROWID)
+		FROM message WHERE group_id = old.group_id))
+		WHERE ROWID = old.group_id; END;
+"""
+
+# schema of the NPS MESSAGE table, as exported to SQLite
+NPS_SCHEMA = """
+CREATE TABLE MESSAGE (Sender TEXT, Receiver TEXT, Content TEXT,
+	Create_date INTEGER, Type TEXT);
+"""
+
+_WORDS = ('ok', 'see', 'you', 'later', 'where', 'are', 'u', 'now', 'on', 'my',
+		'way', 'lunch', 'tmr', 'can', 'call', 'me', 'when', 'free', 'thanks',
+		'haha', 'yes', 'no', 'meeting', 'at', 'the', 'office', 'home', 'soon',
+		u'\u597d', u'\u8c22\u8c22')
+
+class SyntheticData:
+	"""Generates reproducible NPS messages between a number of contacts.
+	A few contacts account for most messages, following Zipf's law, and
+	their numbers are written in the different formats seen in practice."""
+
+	def __init__(self, count, contacts=None, seed=0, start_date=1262304000):
+		self.count = count
+		self.contacts = contacts or max(20, count // 200)
+		self.seed = seed
+		self.start_date = start_date
+
+		rng = random.Random(seed)
+		self.addresses = [self._format_number(rng, 80000000 + rng.randrange(20000000))
+				for i in range(self.contacts)]
+
+		# cumulative Zipf weights
+		self._weights = []
+		total = 0.0
+		for i in range(self.contacts):
+			total += 1.0 / (i + 1)
+			self._weights.append(total)
+
+
+	@staticmethod
+	def _format_number(rng, n):
+		fmt = rng.choice(('%d', '+65%d', '+65 %d', '65%d'))
+		return fmt % n
+
+
+	def rows(self):
+		"""Yields the rows of the NPS MESSAGE table, ordered by date:
+		(Sender, Receiver, Content, Create_date, Type)."""
+
+		rng = random.Random(self.seed + 1)
+		date = self.start_date
+		total = self._weights[-1]
+		for i in xrange(self.count):
+			date += int(rng.expovariate(1.0 / 300)) + 1
+			address = self.addresses[
+					bisect.bisect_left(self._weights, rng.random() * total)]
+
+			msg_type = rng.random() < 0.02 and 'EMS' or 'SMS'
+			content = u' '.join([rng.choice(_WORDS)
+					for j in range(rng.randint(1, 25))])
+			if msg_type == 'EMS':
+				content = None
+
+			if rng.random() < 0.5:
+				yield address, None, content, date, msg_type
+			else:
+				yield None, address + ';', content, date, msg_type
+
+
+	def smses(self):
+		"""Yields the SMS dicts the importer reads from rows()."""
+
+		for row in self.rows():
+			s = NPSSource._make_sms(*row)
+			if s is not None:
+				yield s
+
+
+	def write_nps_db(self, path):
+		"""Writes the messages to an NPS export in SQLite format."""
+
+		if os.path.exists(path):
+			os.unlink(path)
+
+		db = sqlite.connect(path)
+		try:
+			db.executescript(NPS_SCHEMA)
+			db.executemany('INSERT INTO MESSAGE VALUES(?, ?, ?, ?, ?)', self.rows())
+			db.commit()
+		finally:
+			db.close()
+
+
+	def write_sms_db(self, path, country, fraction=0.0):
+		"""Creates an iPhone SMS database, which already contains about
+		"fraction" of the messages, inserted the way the importer does."""
+
+		create_sms_db(path)
+		if not fraction:
+			return
+
+		rng = random.Random(self.seed + 2)
+		isms = iPhoneSMSDB(country, path)
+		try:
+			isms.insert_many(s for s in self.smses() if rng.random() < fraction)
+			isms.commit()
+		finally:
+			isms.close()
+
+
+def create_sms_db(path):
+	"""Creates an empty iPhone SMS database at "path"."""
+
+	if os.path.exists(path):
+		os.unlink(path)
+
+	db = sqlite.connect(path)
+	try:
+		db.create_function('read', 1, lambda f: (int(f) & 0x02) >> 1)
+		db.executescript(SMS_DB_SCHEMA)
+		db.commit()
+	finally:
+		db.close()
+
@@ -19,53 +19,382 @@
 
 from sqlite3 import dbapi2 as sqlite
 import phonenumbers
+import hashlib
+import struct
 import os
+import re
+
+from AddressTable import AddressTable
+
+# number of rows fetched per call when scanning the database
+FETCH_SIZE = 1000
+
+# default number of SMSes inserted per executemany() call
+INSERT_BATCH_SIZE = 500
+
+# additional columns filled in for every inserted SMS
+MESSAGE_DEFAULTS = {
+		'replace':			0,
+		'association_id':	0,
+		'height':			0,
+		'UIFlags':			4,
+		'version':			0,
+		}
+
+# triggers on new SMSes whose effect end_bulk_load() recomputes, by name: 
+# their SQL in sms.db (apart from whitespace), and the msg_group column 
+# they update, for the SMSes after ROWID :last_rowid
+BULK_LOAD_TRIGGERS = {
+	'insert_unread_message': (
+		'CREATE TRIGGER insert_unread_message AFTER INSERT ON message ' + 
+		'WHEN NOT read(new.flags) BEGIN ' + 
+		'UPDATE msg_group SET unread_count = (SELECT unread_count FROM msg_group ' + 
+		'WHERE ROWID = new.group_id) + 1 WHERE ROWID = new.group_id; END',
+		'unread_count = unread_count + (SELECT COUNT(*) FROM message ' + 
+		'WHERE group_id = msg_group.ROWID AND ROWID > :last_rowid AND (flags & 2) = 0)'),
+	'insert_newest_message': (
+		'CREATE TRIGGER insert_newest_message AFTER INSERT ON message ' + 
+		'WHEN new.ROWID >= IFNULL((SELECT MAX(ROWID) FROM message ' + 
+		'WHERE message.group_id = new.group_id), 0) BEGIN ' + 
+		'UPDATE msg_group SET newest_message = new.ROWID ' + 
+		'WHERE ROWID = new.group_id; END',
+		'newest_message = (SELECT MAX(ROWID) FROM message ' + 
+		'WHERE group_id = msg_group.ROWID)'),
+	}
+
+# settings of the fast import profile, see begin_fast_import()
+FAST_IMPORT_PRAGMAS = [
+		('journal_mode',	'TRUNCATE'),
+		('synchronous',		'OFF'),
+		('cache_size',		'-65536'),		# in KiB
+		('temp_store',		'MEMORY'),
+		('mmap_size',		'268435456'),
+		]
 
 class iPhoneSMSDB:
 	"""Class to query and manipulate the iPhone SMS Database."""
 
-	def __init__(self, default_country, sms_db):
+	# tables of the sidecar database
+	_sidecar_schema = [
+		# the watermark is bound to the newest SMS of sms.db when it was set
+		"CREATE TABLE IF NOT EXISTS sidecar.watermark (" + 
+			"source TEXT PRIMARY KEY, date INTEGER NOT NULL, " + 
+			"sms_row INTEGER, sms_date INTEGER)",
+		"CREATE TABLE IF NOT EXISTS sidecar.progress (" + 
+			"source TEXT PRIMARY KEY, date INTEGER, rows INTEGER NOT NULL)",
+		# canonical address of each row of the tables in _indexed_tables
+		"CREATE TABLE IF NOT EXISTS sidecar.address_key (" + 
+			"tbl TEXT NOT NULL, row INTEGER NOT NULL, address TEXT, " + 
+			"key TEXT NOT NULL, PRIMARY KEY(tbl, row))",
+		"CREATE INDEX IF NOT EXISTS sidecar.address_key_key ON address_key(key)",
+		"CREATE TABLE IF NOT EXISTS sidecar.meta (" + 
+			"name TEXT PRIMARY KEY, value)",
+		]
+
+	# tables whose addresses are indexed in sidecar.address_key
+	_indexed_tables = ['group_member', 'message']
+
+	def __init__(self, default_country, sms_db, sidecar_db=None, addresses=None,
+			in_memory=False):
+		"""Opens the iPhone SMS database at "sms_db". If "in_memory" is set, 
+		an in-memory copy of the database (and sidecar database) is used 
+		instead, leaving the files untouched."""
+
 		if not os.path.isfile(sms_db):
 			raise IOError('database doesn\'t exist: ' + sms_db)
 
-		self.db = sqlite.connect(sms_db)
+		self.path = sms_db
+		self.in_memory = in_memory
+		if in_memory:
+			self.db = self._copy_to_memory(sms_db)
+		else:
+			self.db = sqlite.connect(sms_db)
 		self.default_country = default_country.upper()
 		self.dirty = False
 
+		# transactions are handled explicitly, as the sqlite3 module would 
+		# otherwise commit before SAVEPOINT and other non-DML statements
+		self.db.isolation_level = None
+		self._began = False
+		self._savepoints = []
+
+		# normalized addresses, which may be shared with the caller
+		if addresses is None:
+			addresses = AddressTable(self.default_country)
+		self.addresses = addresses
+
 		# register the user-defined function used by triggers
 		# 2nd bit is the "read" bit
 		self.db.create_function('read', 1, lambda f: (int(f) & 0x02) >> 1)
 
+		self.dedup_index = False
+
+		# (triggers, last ROWID before the bulk load), see begin_bulk_load()
+		self._bulk = None
+		self._bulk_resume = False
+
+		# original settings, see begin_fast_import()
+		self._fast = None
+
+		self.sidecar = False
+		if sidecar_db:
+			self.attach_sidecar(sidecar_db)
+			self.sync_address_index()
+			self.commit()
+			self.addresses.update_keys(self.db.execute(
+					"SELECT DISTINCT address, key FROM sidecar.address_key"))
+
+		self.load_groups()
+
+
+	@staticmethod
+	def _copy_to_memory(path):
+		"""Returns an in-memory copy of the database at "path"."""
+
+		src = sqlite.connect(path)
+		db = sqlite.connect(':memory:')
+		try:
+			if hasattr(src, 'backup'):
+				src.backup(db)
+			else:
+				# no backup API before Python 3.7, replay a dump instead.
+				# triggers are created after the data, so read() isn't needed
+				db.executescript('\n'.join(src.iterdump()))
+		finally:
+			src.close()
+		return db
+
 
 	def __del__(self):
 		self.close()
 
 
 	def close(self):
-		if self.db:
+		if getattr(self, 'db', None):
 			self.db.close()
 			self.db = None
 
+	def limit_memory(self, max_bytes):
+		"""Keeps SQLite's page cache to a quarter of "max_bytes", and sorts 
+		and temporary tables on disk."""
+
+		self.db.execute('PRAGMA cache_size = -%d' % max(64, max_bytes // 4096))
+		self.db.execute('PRAGMA temp_store = FILE')
+		self.db.execute('PRAGMA soft_heap_limit = %d' % (max_bytes // 2))
+
+
+	def _pragma(self, name, value=None):
+		"""Returns or sets a PRAGMA of sms.db (not of the sidecar database)."""
+
+		sql = 'PRAGMA %s%s' % (name != 'temp_store' and 'main.' or '', name)
+		if value is not None:
+			sql += ' = %s' % value
+		res = self.db.execute(sql).fetchone()
+		return res and res[0]
+
+
+	def begin_fast_import(self):
+		"""Switches to the settings of FAST_IMPORT_PRAGMAS: a larger cache, 
+		temporary data in memory, memory-mapped I/O, and no waiting for the 
+		disk, while keeping a rollback journal so that an interrupted import 
+		is rolled back. The original settings are restored by 
+		end_fast_import(). Must be called outside of a transaction."""
+
+		if self._fast is not None:
+			return
+		if self.in_transaction():
+			raise sqlite.OperationalError('cannot change settings within a transaction')
+
+		self._fast = [(name, self._pragma(name)) for name, value in FAST_IMPORT_PRAGMAS]
+		for name, value in FAST_IMPORT_PRAGMAS:
+			self._pragma(name, value)
+
+
+	def end_fast_import(self, check='quick_check'):
+		"""Restores the settings changed by begin_fast_import(), and checks 
+		sms.db with the "check" PRAGMA (quick_check or integrity_check). 
+		Uncommitted changes are rolled back. Returns the problems found, or 
+		an empty list if the database is fine."""
+
+		if self._fast is None:
+			return []
+
+		if self.in_transaction():
+			self.rollback()
+
+		for name, value in reversed(self._fast):
+			if value is not None:
+				self._pragma(name, value)
+		self._fast = None
+
+		if not check:
+			return []
+		res = [x[0] for x in self.db.execute('PRAGMA main.' + check).fetchall()]
+		if res == ['ok']:
+			return []
+		return res
+
+
+	def in_transaction(self):
+		return self._began or bool(self._savepoints)
+
+
+	def begin(self):
+		"""Starts a transaction, unless one is already active. This is done 
+		automatically before changes are made."""
+
+		if not self.in_transaction():
+			self.db.execute('BEGIN')
+			self._began = True
+
+
 	def commit(self):
 		"""Commits the database"""
-		self.db.commit()
+
+		# index the addresses of the SMSes added
+		if self.dirty and self.sidecar:
+			self.sync_address_index()
+
+		if self._bulk:
+			self.end_bulk_load()
+		self._bulk_resume = False
+
+		if self.in_transaction():
+			self.db.execute('COMMIT')
+		self._began = False
+		self._savepoints = []
+
+		# the commit changed sms.db, but the index is still up to date
+		if self.dirty and self.sidecar and not self.in_memory:
+			self._set_meta('index_state', self._index_state())
 
 
 	def rollback(self):
 		"""Rolls back changes to the database"""
-		self.db.rollback()
+
+		if self.in_transaction():
+			self.db.execute('ROLLBACK')
+		self._began = False
+		self._savepoints = []
+
+		# forget the groups that were rolled back
+		self.load_groups()
+		self.dedup_index = False
+
+		# the triggers were dropped in the transaction rolled back
+		self._bulk = None
+		self._bulk_resume = False
+
+
+	def savepoint(self, name):
+		"""Marks a savepoint. If no transaction is active, one is started, 
+		which is committed when the savepoint is released."""
+
+		self.db.execute('SAVEPOINT ' + name)
+		self._savepoints.append(name)
+
+		# continue a bulk load interrupted by committing a savepoint
+		if self._bulk_resume:
+			self._bulk_resume = False
+			self.begin_bulk_load()
+
+
+	def release(self, name):
+		"""Releases the savepoint "name" and those marked after it, keeping 
+		their changes."""
+
+		# releasing the outermost savepoint commits
+		if self._bulk and not self._began and self._savepoints[0] == name:
+			self.end_bulk_load()
+			self._bulk_resume = True
+
+		self.db.execute('RELEASE ' + name)
+		del self._savepoints[self._savepoints.index(name):]
+
+
+	def rollback_to(self, name):
+		"""Rolls back the changes made since the savepoint "name" was marked.
+		The savepoint remains active."""
+
+		self.db.execute('ROLLBACK TO ' + name)
+		del self._savepoints[self._savepoints.index(name) + 1:]
+		self.load_groups()
+
+		# the triggers may have been dropped after the savepoint
+		if self._bulk and self._bulk[0] and self._trigger_sql(self._bulk[0][0][0]):
+			self._bulk = None
+
+
+	def _trigger_sql(self, name):
+		c = self.db.cursor()
+		c.execute("SELECT sql FROM main.sqlite_master " + 
+				"WHERE type = 'trigger' AND name = ?", (name,))
+		res = c.fetchone()
+		return res and res[0] or None
+
+
+	@staticmethod
+	def _is_insert_trigger(sql):
+		"""Tests if the trigger created by "sql" fires on INSERT."""
+
+		header = re.split(r'(?i)\bBEGIN\b', sql, 1)[0]
+		return re.search(r'(?i)\bINSERT\s+ON\b', header) is not None
+
+
+	def begin_bulk_load(self):
+		"""Drops the triggers of BULK_LOAD_TRIGGERS, which update msg_group 
+		(calling read()) for every SMS inserted, until end_bulk_load(). 
+		This is done in the current transaction, so that sms.db keeps its 
+		triggers if the transaction is not committed. commit() and the 
+		savepoints end and resume the bulk load as needed.
+		Returns False, leaving the triggers in place, if the message table 
+		has other triggers on new SMSes, whose effect would be lost."""
+
+		if self._bulk is not None:
+			return True
+
+		c = self.db.cursor()
+		c.execute("SELECT name, sql FROM main.sqlite_master " + 
+				"WHERE type = 'trigger' AND tbl_name = 'message' ORDER BY ROWID")
+		triggers = [(name, sql) for name, sql in c.fetchall() 
+				if self._is_insert_trigger(sql)]
+		for name, sql in triggers:
+			if ' '.join(sql.split()) != BULK_LOAD_TRIGGERS.get(name, (None,))[0]:
+				return False
+
+		self.begin()
+		c.execute("SELECT IFNULL(MAX(ROWID), 0) FROM main.message")
+		last_rowid = c.fetchone()[0]
+
+		for name, sql in triggers:
+			c.execute('DROP TRIGGER main."%s"' % name.replace('"', '""'))
+		self._bulk = (triggers, last_rowid)
+		return True
+
+
+	def end_bulk_load(self):
+		"""Updates the groups of the SMSes inserted since begin_bulk_load() 
+		as the dropped triggers would have (the unread count and newest 
+		message), and restores the triggers exactly as they were."""
+
+		triggers, last_rowid = self._bulk
+		c = self.db.cursor()
+		updates = [BULK_LOAD_TRIGGERS[name][1] for name, sql in triggers]
+		if updates:
+			c.execute("UPDATE msg_group SET " + ', '.join(updates) + 
+					" WHERE ROWID IN (SELECT group_id FROM message WHERE ROWID > :last_rowid)", 
+					{'last_rowid': last_rowid})
+
+		for name, sql in triggers:
+			c.execute(sql)
+			if self._trigger_sql(name) != sql:
+				raise sqlite.DatabaseError('trigger %s was not restored' % name)
+		self._bulk = None
 
 
 	def _form_address_query(self, address):
-		numbers = [address,]
-		try:
-			pnumber = phonenumbers.parse(address, self.default_country)
-			numbers.append(phonenumbers.format_number(pnumber, 
-								phonenumbers.PhoneNumberFormat.NATIONAL))
-			numbers.append(phonenumbers.format_number(pnumber, 
-								phonenumbers.PhoneNumberFormat.INTERNATIONAL))
-		except:
-			pass
+		a = self.addresses.get(address)
+		numbers = [x for x in (address, a.national, a.international) if x]
 
 		# strip spaces
 		numbers = set([x.replace(' ', '') for x in numbers])
@@ -86,6 +415,167 @@ class iPhoneSMSDB:
 				d.values()
 
 
+	def attach_sidecar(self, sidecar_db):
+		"""Attaches the sidecar database, which keeps the importer state 
+		outside of the iPhone schema. Changes to it are committed and rolled 
+		back together with the SMS database."""
+
+		self.db.execute("ATTACH DATABASE ? AS sidecar", 
+				(self.in_memory and ':memory:' or sidecar_db,))
+		for stm in self._sidecar_schema:
+			self.db.execute(stm)
+
+		# watermarks of older versions are not bound to an SMS, and are ignored
+		if 'sms_row' not in self._sidecar_columns('sidecar', 'watermark'):
+			for col in ('sms_row', 'sms_date'):
+				self.db.execute('ALTER TABLE sidecar.watermark ADD COLUMN %s INTEGER' 
+						% col)
+
+		# copy the existing state of an in-memory sidecar, without creating 
+		# the file
+		if self.in_memory and os.path.isfile(sidecar_db):
+			self.db.execute("ATTACH DATABASE ? AS sidecar_src", (sidecar_db,))
+			c = self.db.cursor()
+			c.execute("SELECT name FROM sidecar.sqlite_master WHERE type = 'table' " + 
+					"INTERSECT SELECT name FROM sidecar_src.sqlite_master WHERE type = 'table'")
+			for table in [x[0] for x in c.fetchall()]:
+				cols = ', '.join(self._sidecar_columns('sidecar_src', table))
+				self.db.execute('INSERT INTO sidecar.%s(%s) SELECT %s FROM sidecar_src.%s' 
+						% (table, cols, cols, table))
+			self.db.execute("DETACH DATABASE sidecar_src")
+
+		self.sidecar = True
+
+
+	def _sidecar_columns(self, db, table):
+		return [x[1] for x in 
+				self.db.execute('PRAGMA %s.table_info(%s)' % (db, table)).fetchall()]
+
+
+	def _get_meta(self, name):
+		c = self.db.cursor()
+		c.execute("SELECT value FROM sidecar.meta WHERE name = ?", (name,))
+		res = c.fetchone()
+		return res and res[0] or None
+
+
+	def _set_meta(self, name, value):
+		self.db.execute("INSERT OR REPLACE INTO sidecar.meta(name, value) " + 
+				"VALUES(?, ?)", (name, value))
+
+
+	def _index_state(self):
+		"""Returns a string that changes whenever sms.db is modified: its 
+		file change counter and the last ROWID of the indexed tables."""
+
+		counter = None
+		f = open(self.path, 'rb')
+		try:
+			header = f.read(28)
+			if len(header) == 28:
+				counter = struct.unpack('>I', header[24:28])[0]
+		finally:
+			f.close()
+
+		c = self.db.cursor()
+		rowids = []
+		for table in self._indexed_tables:
+			c.execute("SELECT MAX(ROWID) FROM main.%s" % table)
+			rowids.append(c.fetchone()[0])
+
+		return ' '.join([str(x) for x in [counter] + rowids])
+
+
+	def sync_address_index(self):
+		"""Brings the index of canonical addresses in the sidecar database 
+		up to date, normalizing only the addresses of rows added or changed 
+		since it was last updated. The Apple tables are left untouched.
+		Returns the number of addresses indexed."""
+
+		# the file is unchanged since the index was last updated
+		state = self._index_state()
+		if not self.dirty and state == self._get_meta('index_state'):
+			return 0
+
+		self.begin()
+		c = self.db.cursor()
+		count = 0
+		for table in self._indexed_tables:
+			c.execute(("SELECT t.ROWID, t.address FROM main.%s t " + 
+					"LEFT JOIN sidecar.address_key a ON a.tbl = ? AND a.row = t.ROWID " + 
+					"WHERE t.address IS NOT NULL AND " + 
+					"(a.row IS NULL OR a.address IS NOT t.address)") % table, 
+					(table,))
+			rows = [(table, row, address, self.addresses.key(address)) 
+					for row, address in c.fetchall()]
+			c.executemany("INSERT OR REPLACE INTO sidecar.address_key" + 
+					"(tbl, row, address, key) VALUES(?, ?, ?, ?)", rows)
+
+			# rows deleted on the phone
+			c.execute(("DELETE FROM sidecar.address_key WHERE tbl = ? AND " + 
+					"row NOT IN (SELECT ROWID FROM main.%s)") % table, (table,))
+			count += len(rows)
+
+		if not self.dirty:
+			self._set_meta('index_state', state)
+		return count
+
+
+	def get_watermark(self, source):
+		"""Returns the date of the newest SMS imported from "source", or None
+		if nothing was imported from it yet. The watermark is also None if 
+		the SMS it is bound to is not in sms.db, which is then not the one it 
+		was set for (such as that of another iPhone, downloaded to the same 
+		path)."""
+
+		c = self.db.cursor()
+		c.execute("SELECT w.date FROM sidecar.watermark w " + 
+				"JOIN main.message m ON m.ROWID = w.sms_row AND m.date = w.sms_date " + 
+				"WHERE w.source = ?", (source,))
+		res = c.fetchone()
+		return res and res[0] or None
+
+
+	def set_watermark(self, source, date):
+		"""Records "date" as the newest SMS imported from "source", bound to 
+		the newest SMS of sms.db, see get_watermark()."""
+
+		self.begin()
+		c = self.db.cursor()
+		c.execute("DELETE FROM sidecar.watermark WHERE source = ?", (source,))
+		c.execute("INSERT INTO sidecar.watermark(source, date, sms_row, sms_date) " + 
+				"SELECT ?, ?, ROWID, date FROM main.message " + 
+				"ORDER BY ROWID DESC LIMIT 1", (source, date))
+
+
+	def get_progress(self, source):
+		"""Returns the progress (date, rows) recorded by an interrupted import 
+		from "source", or None. "date" is the date of the last SMS processed, 
+		"rows" the number of SMSes processed."""
+
+		c = self.db.cursor()
+		c.execute("SELECT date, rows FROM sidecar.progress WHERE source = ?", 
+				(source,))
+		return c.fetchone()
+
+
+	def set_progress(self, source, date, rows):
+		"""Records the progress of an import from "source"."""
+
+		self.begin()
+		c = self.db.cursor()
+		c.execute("INSERT OR REPLACE INTO sidecar.progress(source, date, rows) " + 
+				"VALUES(?, ?, ?)", (source, date, rows))
+
+
+	def clear_progress(self, source):
+		"""Removes the progress of a completed import from "source"."""
+
+		self.begin()
+		c = self.db.cursor()
+		c.execute("DELETE FROM sidecar.progress WHERE source = ?", (source,))
+
+
 	def get_latest_sms_date(self):
 		c = self.db.cursor()
 		c.execute("SELECT MAX(date) FROM message;")
@@ -93,38 +583,88 @@ class iPhoneSMSDB:
 		return latest_sms_ts
 
 
+	def load_groups(self):
+		"""Loads the index of groups by canonical address, used by 
+		get_group_id(). Each member address is normalized once."""
+
+		self.groups = {}
+		c = self.db.cursor()
+
+		# canonical addresses come from the sidecar index, where available. 
+		# groups committed at a checkpoint are not indexed yet
+		if self.sidecar:
+			c.execute("SELECT g.address, g.group_id, a.key FROM group_member g " + 
+					"LEFT JOIN sidecar.address_key a ON a.tbl = 'group_member' " + 
+						"AND a.row = g.ROWID AND a.address = g.address " + 
+					"ORDER BY g.ROWID")
+		else:
+			c.execute("SELECT address, group_id, NULL FROM group_member ORDER BY ROWID")
+
+		for address, group_id, key in c.fetchall():
+			if address:
+				self.groups.setdefault(key or self.addresses.key(address), group_id)
+
+
 	def get_group_id(self, address):
 		"""Retrieves the group_id given an "address"."""
 
-		c = self.db.cursor()
-		c.execute("SELECT group_id FROM group_member " + 
-				"WHERE " + self._form_address_query(address))
-		res = c.fetchone()
-		return res and res[0] or None
+		return self.groups.get(self.addresses.key(address))
 
 
 	def add_group(self, address):
 		"""Adds a group for the given "address" and returns the group_id."""
 
+		self.begin()
 		c = self.db.cursor()
 		c.execute("INSERT INTO msg_group(type, unread_count, hash) " + 
 				"VALUES(0, 0, NULL)")
 		group_id = c.lastrowid
 
-		country = self.get_number_country(address, self.default_country)
+		country = self.addresses.get(address).region
 		c.execute("INSERT INTO group_member(group_id, address, country) " + 
 				"VALUES(?, ?, ?)", 
 				(group_id, address, country))
+		self.groups.setdefault(self.addresses.key(address), group_id)
 		self.dirty = True
 
 		return group_id
 
 
+	def create_dedup_index(self):
+		"""Indexes the date and direction of the SMSes for sms_exists(), 
+		which otherwise scans the message table. The index is kept in a TEMP 
+		table, and a TEMP trigger adds the SMSes inserted. Both only exist for 
+		this connection, so nothing is added to sms.db itself."""
+
+		c = self.db.cursor()
+		c.execute("SELECT 1 FROM sqlite_temp_master WHERE name = 'message_dedup'")
+		if c.fetchone() is None:
+			c.execute("CREATE TEMP TABLE message_dedup (" + 
+					"date INTEGER, dir INTEGER, row INTEGER)")
+			c.execute("INSERT INTO temp.message_dedup " + 
+					"SELECT date, flags & 1, ROWID FROM main.message")
+			c.execute("CREATE INDEX temp.message_dedup_index " + 
+					"ON message_dedup(date, dir, row)")
+			c.execute("CREATE TEMP TRIGGER message_dedup_insert " + 
+					"AFTER INSERT ON main.message BEGIN " + 
+					"INSERT INTO message_dedup VALUES(new.date, new.flags & 1, new.ROWID); " + 
+					"END")
+		self.dedup_index = True
+
+
 	def sms_exists(self, sms):
 		"""Tests if the specified SMS (dict) already exists.
 		Matches SMS contents (text), date and "address"."""
 
 		c = self.db.cursor()
+		if self.dedup_index:
+			c.execute('SELECT 1 FROM temp.message_dedup d ' + 
+						'JOIN main.message m ON m.ROWID = d.row ' + 
+						'WHERE d.date = ? AND d.dir = ? AND m.text = ? AND ' + 
+						self._form_address_query(sms['address']), 
+							(sms['date'], sms['flags'] & 1, sms['text']))
+			return c.fetchone() is not None
+
 		c.execute('SELECT * FROM message ' + 
 					'WHERE text = ? AND date = ? AND (flags & 1) = ? AND ' +
 					self._form_address_query(sms['address']), 
@@ -132,6 +672,122 @@ class iPhoneSMSDB:
 		return c.fetchone() is not None
 
 
+	def address_key(self, address):
+		"""Returns the canonical form of an "address". See AddressTable.key()."""
+
+		return self.addresses.key(address)
+
+
+	@staticmethod
+	def text_digest(text):
+		"""Returns a digest of the SMS text, for use in fingerprints."""
+
+		if isinstance(text, unicode):
+			text = text.encode('utf-8')
+		return hashlib.sha1(text).digest()
+
+
+	def sms_fingerprint(self, sms, address_key=None):
+		"""Returns a hashable fingerprint of the SMS (dict), which is equal for 
+		SMSes that sms_exists() considers duplicates. The canonical address 
+		can be passed in "address_key" if it is already known."""
+
+		if address_key is None:
+			address_key = self.address_key(sms['address'])
+		return (sms['date'], sms['flags'] & 1, address_key, 
+				self.text_digest(sms['text']))
+
+
+	def load_fingerprints(self, min_date=None, max_date=None):
+		"""Returns the set of fingerprints of all SMSes dated between 
+		"min_date" and "max_date" (inclusive, either may be None).
+		Checking fingerprints against this set replaces one sms_exists() 
+		query per SMS."""
+
+		return set(self.iter_fingerprints(min_date, max_date))
+
+
+	def iter_fingerprints(self, min_date=None, max_date=None, ordered=False, 
+			group_id=None):
+		"""Yields the fingerprints of all SMSes dated between "min_date" and 
+		"max_date", like load_fingerprints(). If "ordered" is set, they are 
+		yielded in date order. If "group_id" is given, only the SMSes of that 
+		group are considered."""
+
+		# canonical addresses come from the sidecar index, where available
+		if self.sidecar:
+			sql = 'SELECT m.address, m.date, m.text, m.flags, a.key FROM message m ' + \
+					"LEFT JOIN sidecar.address_key a ON a.tbl = 'message' AND a.row = m.ROWID "
+		else:
+			sql = 'SELECT m.address, m.date, m.text, m.flags, NULL FROM message m '
+
+		sql += 'WHERE m.text IS NOT NULL'
+		args = []
+		if group_id is not None:
+			sql += ' AND m.group_id = ?'
+			args.append(group_id)
+		if min_date is not None:
+			sql += ' AND m.date >= ?'
+			args.append(min_date)
+		if max_date is not None:
+			sql += ' AND m.date <= ?'
+			args.append(max_date)
+		if ordered:
+			sql += ' ORDER BY m.date'
+
+		c = self.db.cursor()
+		c.execute(sql, args)
+		while True:
+			rows = c.fetchmany(FETCH_SIZE)
+			if not rows:
+				break
+
+			for address, date, text, flags, key in rows:
+				if address is None:
+					continue
+
+				yield (date, (flags or 0) & 1, key or self.addresses.key(address), 
+						self.text_digest(text))
+
+
+	def iter_messages(self, fetch_size=FETCH_SIZE):
+		"""Yields all SMSes as dicts, in ROWID order, fetching "fetch_size" 
+		rows at a time. Besides the message columns, "group_address" is the 
+		address of the SMS group and "e164" the canonical form of the address 
+		(see AddressTable.key())."""
+
+		c = self.db.cursor()
+
+		# address of the first member of each group, as groups are few
+		group_addresses = {}
+		c.execute('SELECT group_id, address FROM group_member ORDER BY ROWID')
+		for group_id, address in c.fetchall():
+			group_addresses.setdefault(group_id, address)
+
+		c.execute('SELECT ROWID, date, address, text, flags, group_id, country ' + 
+				'FROM message ORDER BY ROWID')
+
+		while True:
+			rows = c.fetchmany(fetch_size)
+			if not rows:
+				break
+
+			for rowid, date, address, text, flags, group_id, country in rows:
+				group_address = group_addresses.get(group_id)
+				key = address or group_address
+				yield {
+					'rowid':			rowid,
+					'date':				date,
+					'address':			address,
+					'e164':				key and self.addresses.key(key) or None,
+					'text':				text,
+					'flags':			flags,
+					'group_id':			group_id,
+					'group_address':	group_address,
+					'country':			country,
+					}
+
+
 	def insert_sms(self, sms):
 		"""Inserts the given SMS.
 		Checks if the address of the SMS already has a group, otherwise calls 
@@ -143,29 +799,87 @@ class iPhoneSMSDB:
 			group_id = self.add_group(address)
 
 		# fill in the country of the number
-		sms['country'] = self.get_number_country(address, self.default_country)
+		sms['country'] = self.addresses.get(address).region
 
 		# update group_id in sms
 		sms['group_id'] = group_id
 
 		# add additional columns
-		opts = {
-				'replace':			0,
-				'association_id':	0,
-				'height':			0,
-				'UIFlags':			4,
-				'version':			0,
-				}
-
-		sms = dict(sms.items() + opts.items())
+		sms = dict(sms.items() + MESSAGE_DEFAULTS.items())
 
 		stm, vals = self._dict_to_sql_insert('INSERT INTO message', sms)
 
+		self.begin()
 		c = self.db.cursor()
 		c.execute(stm, vals)
 		self.dirty = True
 
 
+	# column order used by insert_many()
+	_default_columns = sorted(MESSAGE_DEFAULTS.keys())
+	_insert_columns = ['address', 'date', 'text', 'flags', 'group_id', 
+			'country'] + _default_columns
+
+	_insert_many_sql = 'INSERT INTO message(%s) VALUES(%s)' % (
+			','.join(_insert_columns), ','.join(['?'] * len(_insert_columns)))
+
+	def insert_many(self, smses, batch_size=INSERT_BATCH_SIZE):
+		"""Inserts the given SMSes (an iterable of dicts), "batch_size" at a 
+		time, using a single prepared statement. Groups are looked up once 
+		per distinct address in each batch, and added where needed.
+		Returns the list of addresses for which groups were added."""
+
+		added = []
+		batch = []
+		for sms in smses:
+			batch.append(sms)
+			if len(batch) >= batch_size:
+				self._insert_batch(batch, added)
+				batch = []
+
+		if batch:
+			self._insert_batch(batch, added)
+
+		return added
+
+
+	def _insert_batch(self, batch, added):
+		# resolve group and country of each distinct address
+		groups = {}
+		for sms in batch:
+			address = sms['address']
+			if address in groups:
+				continue
+
+			group_id = self.get_group_id(address)
+			if group_id is None:
+				group_id = self.add_group(address)
+				added.append(address)
+
+			groups[address] = (group_id, 
+					self.addresses.get(address).region)
+
+		rows = []
+		for sms in batch:
+			group_id, country = groups[sms['address']]
+			rows.append((sms['address'], sms['date'], sms['text'], 
+					sms['flags'], group_id, country))
+
+		self.insert_rows(rows)
+
+
+	def insert_rows(self, rows):
+		"""Inserts SMSes given as (address, date, text, flags, group_id, 
+		country) tuples, whose groups already exist."""
+
+		defaults = [MESSAGE_DEFAULTS[k] for k in self._default_columns]
+
+		self.begin()
+		c = self.db.cursor()
+		c.executemany(self._insert_many_sql, [list(r) + defaults for r in rows])
+		self.dirty = True
+
+
 	@staticmethod
 	def get_number_country(number, default_country):
 		"""Retrieves the country code for a given number. If no international 
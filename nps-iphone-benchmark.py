@@ -0,0 +1,288 @@
+#
+# nps-iphone-benchmark.py - benchmarks the importer on synthetic data
+# Copyright (C) 2011 Darell Tan
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+
+import os, sys
+import time
+import json
+import getopt
+import shutil
+import tempfile
+import platform
+from sqlite3 import dbapi2 as sqlite
+
+from iPhoneSMSDB import iPhoneSMSDB
+from NPSSource import SQLiteNPSSource
+from AddressTable import AddressTable
+from ImportStats import ImportStats
+from SMSImporter import SMSImporter, instrument_import
+from SyntheticData import SyntheticData
+
+# import modes benchmarked, and the SMSImporter options of each
+MODES = {
+	'default':		{},
+	'bulk_dedup':	{'bulk_dedup': True},
+	'skew':			{'skew': 5},
+	}
+
+def bench_pipeline(mode, nps_db, sms_db, config):
+	"""Imports "nps_db" into a copy of "sms_db", returning the timings."""
+
+	work_db = sms_db + '.' + mode
+	shutil.copyfile(sms_db, work_db)
+
+	stats = ImportStats()
+	addresses = AddressTable(config['country'])
+	isms = iPhoneSMSDB(config['country'], work_db, work_db + '-import.db', addresses)
+	instrument_import(stats, isms, addresses)
+	try:
+		importer = SMSImporter(isms, [SQLiteNPSSource(nps_db)], stats, **MODES[mode])
+		counts = importer.run()
+		with stats.phase('commit'):
+			isms.commit()
+	finally:
+		isms.close()
+		stats.finish()
+		for x in (work_db, work_db + '-import.db'):
+			if os.path.exists(x):
+				os.unlink(x)
+
+	d = stats.to_dict()
+	d['counters'] = counts
+	return d
+
+def bench_methods(data, sms_db, config):
+	"""Times each iPhoneSMSDB method on a sample of the messages. Changes
+	are rolled back."""
+
+	samples = int(config['samples'])
+	step = max(1, data.count // samples)
+	sample = [s for i, s in enumerate(data.smses()) if i % step == 0][:samples]
+
+	stats = ImportStats()
+	isms = iPhoneSMSDB(config['country'], sms_db)
+	try:
+		for method in ('sms_exists', 'get_group_id', 'address_key', 'sms_fingerprint'):
+			stats.instrument(isms, method, method)
+		stats.instrument(isms, 'add_group', 'add_group')
+		stats.instrument(isms, 'insert_many', 'insert_many', lambda smses, *a: len(smses))
+		stats.instrument(isms, 'load_fingerprints', 'load_fingerprints', lambda *a: 0)
+
+		for s in sample:
+			isms.sms_exists(s)
+		for s in sample:
+			isms.get_group_id(s['address'])
+
+		# addresses are normalized once, so time them on a fresh table
+		isms.addresses = AddressTable(config['country'])
+		for s in sample:
+			isms.address_key(s['address'])
+		for s in sample:
+			isms.sms_fingerprint(s)
+
+		for i in range(len(sample)):
+			isms.add_group('+1555%07d' % i)
+		isms.insert_many(sample)
+
+		isms.load_fingerprints()
+		for x in stats.iterate('iter_fingerprints', isms.iter_fingerprints(ordered=True)):
+			pass
+		for x in stats.iterate('iter_messages', isms.iter_messages()):
+			pass
+	finally:
+		isms.rollback()
+		isms.close()
+		stats.finish()
+
+	methods = {}
+	for name, p in stats.to_dict()['phases'].items():
+		p['seconds_per_call'] = p['calls'] and round(p['seconds'] / p['calls'], 9) or 0.0
+		methods[name] = p
+	return methods
+
+def bench_size(count, workdir, config):
+	"""Runs the benchmarks on "count" synthetic messages."""
+
+	seed = int(config['seed'])
+	data = SyntheticData(count, seed=seed)
+	nps_db = os.path.join(workdir, 'nps-%d.sqlite' % count)
+	sms_db = os.path.join(workdir, 'sms-%d.db' % count)
+
+	result = {'messages': count, 'contacts': data.contacts, 'generate': {},
+			'pipeline': {}, 'methods': None}
+
+	started = time.time()
+	data.write_nps_db(nps_db)
+	result['generate']['nps_db'] = round(time.time() - started, 6)
+
+	started = time.time()
+	data.write_sms_db(sms_db, config['country'], float(config['overlap']))
+	result['generate']['sms_db'] = round(time.time() - started, 6)
+	result['existing'] = existing_count(sms_db)
+
+	for mode in config['modes'].split(','):
+		if config['verbose']: print "  import,", mode, "mode...",
+		r = result['pipeline'][mode] = bench_pipeline(mode, nps_db, sms_db, config)
+		if config['verbose']: print "%.2fs" % r['elapsed']
+
+	if config['verbose']: print "  methods..."
+	result['methods'] = bench_methods(data, sms_db, config)
+
+	if not config['keep']:
+		os.unlink(nps_db)
+		os.unlink(sms_db)
+
+	return result
+
+def existing_count(sms_db):
+	db = sqlite.connect(sms_db)
+	try:
+		return db.execute('SELECT COUNT(*) FROM message').fetchone()[0]
+	finally:
+		db.close()
+
+def print_usage():
+	print """
+NPS SMS Importer benchmark.
+
+%s [--sizes <n,...>] [--output <file>] ...
+
+Generates NPS exports and iPhone SMS databases with synthetic messages,
+times the import and the iPhoneSMSDB methods, and saves the results as JSON.
+
+args:
+
+  --sizes <n,...>
+      Numbers of messages to benchmark with. By default, 10000,100000,1000000.
+
+  --modes <mode,...>
+      Import modes to time: "default", "bulk_dedup" and/or "skew".
+
+  --overlap <fraction>
+      Fraction of the messages already in the iPhone SMS database, which
+      are found to be duplicates. By default, 0.5.
+
+  --samples <n>
+      Number of calls timed for each iPhoneSMSDB method. By default, 200.
+
+  --country <country>
+      Country code for numbers without international prefix. By default, sg.
+
+  --seed <n>
+      Seed of the generated data. The same seed gives the same data.
+
+  --output <file>
+      JSON file the results are written to. By default, benchmark.json.
+
+  --workdir <dir>
+      Directory for the generated databases. By default, a temporary one.
+
+  --keep
+      Keeps the generated databases.
+
+  --verbose
+      Prints the progress of the benchmark.
+""" % sys.argv[0]
+
+
+if __name__ == '__main__':
+	config = {
+		'sizes':		'10000,100000,1000000',
+		'modes':		'default,bulk_dedup,skew',
+		'overlap':		'0.5',
+		'samples':		'200',
+		'country':		'sg',
+		'seed':			'0',
+		'output':		'benchmark.json',
+		'workdir':		None,
+		'keep':			False,
+		'verbose':		0,
+		'help':			False,
+	}
+
+	try:
+		def needs_arg(k):
+			return config[k] is None or type(config[k]) is str
+
+		opts, args = getopt.getopt(sys.argv[1:], '',
+				[k.replace('_', '-') + ("=" if needs_arg(k) else "")
+					for k in config.keys()])
+	except getopt.GetoptError, err:
+		print 'error: ', str(err)
+		print_usage()
+		sys.exit(2)
+
+	for opt, arg in opts:
+		opt = opt[2:].replace('-', '_')
+
+		if type(config[opt]) is bool:
+			config[opt] = True
+		elif type(config[opt]) is int:
+			config[opt] = config[opt] + 1
+		else:
+			config[opt] = arg
+
+	if config['help']:
+		print_usage()
+		sys.exit(0)
+
+	for mode in config['modes'].split(','):
+		if mode not in MODES:
+			print "error: unknown mode", mode
+			print_usage()
+			sys.exit(2)
+
+	workdir = config['workdir'] or tempfile.mkdtemp(prefix='nps-benchmark-')
+	if not os.path.isdir(workdir):
+		os.makedirs(workdir)
+
+	report = {
+		'started':	time.time(),
+		'python':	platform.python_version(),
+		'sqlite':	sqlite.sqlite_version,
+		'platform':	platform.platform(),
+		'config':	dict([(k, config[k]) for k in
+						('sizes', 'modes', 'overlap', 'samples', 'country', 'seed')]),
+		'results':	[],
+		}
+
+	try:
+		for count in [int(x) for x in config['sizes'].split(',')]:
+			print "benchmarking", count, "messages"
+			report['results'].append(bench_size(count, workdir, config))
+
+			# save after each size, as the large ones take a while
+			f = open(config['output'], 'w')
+			try:
+				json.dump(report, f, indent=2, sort_keys=True)
+			finally:
+				f.close()
+	finally:
+		if not config['workdir'] and not config['keep']:
+			shutil.rmtree(workdir, True)
+
+	print
+	print '%-10s %-12s %10s %10s %10s' % ('messages', 'mode', 'seconds', 'inserted', 'SMS/s')
+	for r in report['results']:
+		for mode, p in sorted(r['pipeline'].items()):
+			print '%-10d %-12s %10.2f %10d %10.1f' % (r['messages'], mode,
+					p['elapsed'], p['counters']['inserted'],
+					p['elapsed'] and p['counters']['total'] / p['elapsed'] or 0.0)
+	print
+	print "results saved to", config['output']
+
@@ -18,77 +18,187 @@
 #
 
 import os, sys
-import operator
+import time
+import json
 import getopt
+from sqlite3 import dbapi2 as sqlite
 
-import win32com.client
-from   win32com.shell import shell, shellcon
-import AMDevice
-from iPhoneSMSDB import iPhoneSMSDB
+from iPhoneSMSDB import iPhoneSMSDB, INSERT_BATCH_SIZE
+from NPSSource import open_NPS_source
+from AddressTable import AddressTable
+from ImportStats import ImportStats, peak_rss
+from SMSImporter import SMSImporter, parse_after_date, instrument_import
 
 # location of sms.db on the iPhone
 IPHONE_SMS_DB = '/var/mobile/Library/SMS/sms.db'
 
-def read_NPS_sms(nps_db_path=None, filters=[]):
-	"""Reads SMSes from the Samsung New PC Studio (NPS) internal database."""
-
-	# locate NPS database
-	if not nps_db_path:
-		appdata_dir = shell.SHGetFolderPath(0, shellcon.CSIDL_APPDATA, None, 0)
-		nps_db_path = os.path.join(appdata_dir, 'Samsung', 'New PC Studio', 'Guest.dat')
-
-	if not os.path.isfile(nps_db_path):
-		raise IOError('unable to find Samsung NPS database at ' + nps_db_path)
-
-	adoconn = win32com.client.Dispatch(r'ADODB.Connection')
-	DSN = 'PROVIDER=Microsoft.Jet.OLEDB.4.0;DATA SOURCE=' + nps_db_path
-	adoconn.Open(DSN)
-	rs = win32com.client.Dispatch(r'ADODB.Recordset')
-
-	rs.Cursorlocation = 3;
-	nps_sql = "SELECT *, IIF(SENDER IS NOT NULL, 2, 3) AS FLAGS FROM MESSAGE"
-	if filters:
-		nps_sql += " WHERE " + " AND ".join(filters)
-	rs.Open(nps_sql, adoconn);
-
-	sms = []
-	if (rs.RecordCount):
-		while not rs.EOF:
-			address = None
-			if rs.Fields.Item('Sender').Value:
-				address = rs.Fields.Item('Sender').Value
-			else:
-				address = rs.Fields.Item('Receiver').Value
+# default number of seconds between checks for changes in --watch mode
+WATCH_INTERVAL = 5
+
+def import_interrupted(state_db):
+	"""Tests if the state database records the progress of an import that 
+	was interrupted after a checkpoint."""
+
+	if not os.path.isfile(state_db):
+		return False
 
-			# skip SMSes with no address - these are likely drafts
-			if address is None:
-				rs.MoveNext()
+	db = sqlite.connect(state_db)
+	try:
+		c = db.cursor()
+		c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'progress'")
+		if c.fetchone() is None:
+			return False
+		c.execute("SELECT 1 FROM progress LIMIT 1")
+		return c.fetchone() is not None
+	finally:
+		db.close()
+
+def print_counts(counts, config, addresses):
+	print
+	if config['verbose']: print "distinct addresses:\t", len(addresses)
+	print "new groups:\t", counts['new_groups']
+	print
+	print "duplicate:\t", counts['duplicate']
+	print "inserted:\t", counts['inserted']
+	print "TOTAL:\t\t", counts['total']
+	print
+
+def source_state(sources):
+	"""Returns the modification time and size of each source file."""
+
+	state = []
+	for source in sources:
+		try:
+			st = os.stat(source.path)
+			state.append((st.st_mtime, st.st_size))
+		except OSError:
+			state.append(None)
+	return state
+
+def watch(importer, config):
+	"""Imports new SMSes whenever the NPS databases change, until 
+	interrupted. The database connection and normalized addresses are kept 
+	between imports."""
+
+	isms = importer.isms
+	interval = float(config['watch_interval'] or WATCH_INTERVAL)
+	last_state = None
+
+	print "watching", ', '.join([x.path for x in importer.sources]), \
+			"for changes (Ctrl-C to stop)"
+	while True:
+		state = source_state(importer.sources)
+		if state != last_state:
+			# wait for NPS to finish writing
+			time.sleep(interval)
+			if source_state(importer.sources) != state:
 				continue
 
-			# strip trailing semicolon
-			address = address.replace(';', '')
+			try:
+				counts = importer.run()
+			except (KeyboardInterrupt, SystemExit):
+				raise
+			except Exception, err:
+				isms.rollback()
+				print time.ctime(), "import failed:", str(err)
+			else:
+				if config['dry_run']:
+					isms.rollback()
+				else:
+					isms.commit()
+				print time.ctime(), "inserted %(inserted)d, duplicate %(duplicate)d, " \
+						"new groups %(new_groups)d" % counts
+
+				# only the changes are imported from now on
+				importer.after_date = None
+				importer.full_sync = False
 
-			s = {
-				'address':	address,
-				'text':		rs.Fields.Item('Content').Value,
-				'date':		int( rs.Fields.Item('Create_date').Value ),
-				'flags':	rs.Fields.Item('Flags').Value,
-				}
+			last_state = state
 
-			if rs.Fields.Item('Type').Value == 'EMS':
-				s['text'] = '<Imported EMS Placeholder>';
+		time.sleep(interval)
 
-			sms.append(s)
+def end_fast_import(isms, config, stats):
+	"""Restores the settings of the iPhone SMS database after --fast-import,
+	and checks it. Returns False if it is damaged."""
 
-			rs.MoveNext()
+	if not config['fast_import']:
+		return True
 
-	return sms
+	# nothing was written on a dry run
+	if config['dry_run']:
+		isms.end_fast_import(None)
+		return True
+
+	with stats.phase('check'):
+		problems = isms.end_fast_import('quick_check')
+	if problems:
+		print "error: the iPhone SMS database failed the integrity check:"
+		for p in problems:
+			print "  " + p
+		return False
+	return True
+
+def report_stats(stats, config):
+	"""Prints and/or saves the import statistics, if requested."""
+
+	stats.finish()
+	if config['stats']:
+		print stats.report()
+		print
+	if config['stats_json']:
+		stats.write_json(config['stats_json'])
+	if stats.memory:
+		print stats.memory.report()
+		print
+
+def run_batch_manifest(config):
+	"""Runs the import jobs listed in the --batch manifest. Options given 
+	on the command line apply to all jobs, unless overridden by the 
+	manifest. Returns the number of failed jobs."""
+
+	import BatchImport
+
+	jobs = BatchImport.read_manifest(config['batch'])
+	for job in jobs:
+		job['country'] = job['country'] or config['country']
+		job['dry_run'] = config['dry_run']
+		job['skip_ems'] = config['skip_ems']
+		job['full_sync'] = config['full_sync']
+		job['bulk_dedup'] = config['bulk_dedup']
+		job['batch_size'] = int(config['batch_size'] or INSERT_BATCH_SIZE)
+		job['checkpoint'] = int(config['checkpoint'] or 0)
+		job['skew'] = int(config['skew'] or 0)
+		job['max_memory'] = config['max_memory'] and int(config['max_memory']) * 1048576
+		job['pipeline'] = config['pipeline']
+		job['defer_triggers'] = config['defer_triggers']
+		job['fast_import'] = config['fast_import']
+
+	started = time.time()
+	results = []
+	for r in BatchImport.run_batch(jobs, config['jobs'] and int(config['jobs']) or None):
+		if config['verbose']:
+			print r['job']['smsdb'] + ':', r['error'] or 'ok'
+		results.append(r)
+
+	report = BatchImport.batch_report(results, time.time() - started)
+	print
+	print BatchImport.format_batch_report(report)
+	print
+
+	if config['stats_json']:
+		f = open(config['stats_json'], 'w')
+		try:
+			json.dump(report, f, indent=2, sort_keys=True)
+		finally:
+			f.close()
+
+	return report['failed']
 
 def print_usage():
 	print """
 NPS SMS Importer.
 
-%s --country <country> [--smsdb <x> | --npsdb <x> | --verbose ] ...
+%s --country <country> [--smsdb <x> | --npsdb <x> ... | --verbose ] ...
 
 args:
 
@@ -97,8 +207,7 @@ args:
       international prefix. Usually the country where your SMSes originate.
 
   --after-date <mm/dd/yyyy>
-      Only import SMSes after the specified date. The date format must be 
-	  understood by MS Access, or just use the "mm/dd/yyyy" format.
+      Only import SMSes after the specified date.
 
   --smsdb <iphone-sms.db>
       Specifies iPhone SMS database file
@@ -107,10 +216,120 @@ args:
   --npsdb <nps-db.dat>
       Specifies the Samsung NPS database file (usually called "Guest.dat")
       By default, this is at "%%AppData%%\Samsung\New PC Studio\Guest.dat"
+      Can be specified multiple times to import from several NPS databases 
+      at once; SMSes found in more than one of them are imported only once.
+      An export of the MESSAGE table as a ".csv" file or an SQLite database 
+      (".db", ".sqlite" or ".sqlite3") can also be specified.
+
+  --state-db <x>
+      Specifies the database used to keep the import state, such as the 
+      date of the newest SMS imported from each NPS database. By default,
+      "-import.db" is appended to the iPhone SMS database file name.
+
+  --full-sync
+      Reads all SMSes from the NPS database. By default, only SMSes since 
+      the newest one imported by a previous run are read.
+
+  --bulk-dedup
+      Loads all existing SMSes from the iPhone SMS database once to detect 
+      duplicates, instead of querying the database for every SMS. This is 
+      much faster for large imports, at the cost of memory.
+
+  --skew <seconds>
+      Also treats SMSes dated up to the specified number of seconds apart as 
+      duplicates, if they have the same direction, phone number and text.
+      Useful when the iPhone already has SMSes copied through another route,
+      which may have slightly different dates.
+
+  --batch-size <n>
+      Number of SMSes inserted into the iPhone SMS database at a time.
+      By default, %d SMSes are inserted at a time.
+
+  --max-memory <MiB>
+      Keeps memory use within about the specified number of megabytes, for 
+      large imports on machines with little memory. SMSes are streamed from 
+      the NPS database through to the iPhone SMS database, existing SMSes 
+      are not loaded for --bulk-dedup, CSV exports are sorted on disk and 
+      the SQLite cache is limited. The peak memory use is printed at the end.
+
+  --pipeline
+      Reads each NPS database in a thread of its own, and normalizes the 
+      SMSes in another, while the main thread writes to the iPhone SMS 
+      database. The stages are connected by bounded queues, whose 
+      statistics are shown by --stats.
+
+  --shards <n>
+      Deduplicates the SMSes in <n> worker processes, each handling the 
+      SMSes of some of the phone numbers, while the main process adds the 
+      groups and inserts the SMSes. Cannot be used with --checkpoint, 
+      --skew, --max-memory, --pipeline or --batch.
+
+  --defer-triggers
+      Drops the triggers of the iPhone SMS database while inserting, and 
+      updates the SMS groups once at the end instead of for every SMS. 
+      The triggers are restored unchanged before committing. If the 
+      database has other triggers on new SMSes, nothing is deferred.
+
+  --fast-import
+      Speeds up writing to the iPhone SMS database by not waiting for the 
+      disk and caching more, for the duration of the import. The original 
+      settings are restored and the database is checked afterwards; it is 
+      not uploaded to the iPhone if the check fails. A power failure during 
+      the import may damage the database, so keep a copy of it.
+
+  --stats
+      Prints the time taken and the throughput of each phase of the import.
+
+  --stats-json <file>
+      Writes the statistics printed by --stats to a JSON file.
+
+  --profile <file>
+      Profiles the whole run with cProfile, saving the statistics to the 
+      specified file. Use the pstats module to examine them.
+
+  --memprofile
+      Reports the top memory allocation sites after the SMSes were read, 
+      deduplicated and inserted, and after committing. Without tracemalloc 
+      (before Python 3.4), the peak memory use and the number of objects of 
+      each type are reported instead.
+
+  --checkpoint <n>
+      Commits the import every <n> SMSes, recording its progress. If the 
+      import is interrupted, the next run resumes from the last checkpoint.
+      The "commit?" prompt is skipped, as changes are committed as they go.
+      With --iphone, the next run resumes with the local sms.db instead of 
+      downloading it again, and uploads it when done; SMSes received on the 
+      iPhone in the meantime are overwritten.
+
+  --watch
+      Keeps running, importing new SMSes whenever the NPS database changes.
+      Imported SMSes are committed without prompting. Cannot be used with 
+      --iphone.
+
+  --watch-interval <seconds>
+      Number of seconds between checks for changes in --watch mode.
+      By default, this is %d seconds.
+
+  --batch <manifest>
+      Runs the imports listed in a JSON or CSV manifest, which specify the 
+      "npsdb", "smsdb", "country", "after_date" and "state_db" of each job. 
+      Multiple NPS databases are separated by ";". The other options given 
+      apply to all jobs. Changes are committed without prompting.
+      An aggregated report is printed, and saved with --stats-json.
+
+  --jobs <n>
+      Number of --batch jobs run concurrently. By default, one job is run 
+      per CPU.
+
+  --export <file>
+      Exports all SMSes in the iPhone SMS database to the specified file 
+      instead of importing, as CSV if its name ends in ".csv", otherwise as 
+      JSON lines. Addresses are also given in the E.164 format.
 
   --dry-run
-      Performs all the steps, but discards changes to the iPhone SMS database
-	  at the end. Specifying this flag will skip the final "commit?" prompt.
+      Performs all the steps on an in-memory copy of the iPhone SMS database,
+	  which is discarded at the end. The database file is not modified.
+	  Specifying this flag will skip the final "commit?" prompt.
 
   --skip-ems
       Skips EMSes, which include SMSes longer than 160 characters.
@@ -120,12 +339,12 @@ args:
 
   --verbose
       Prints raw SMS details (can be specified multiple times)
-""" % (sys.argv[0])
+""" % (sys.argv[0], INSERT_BATCH_SIZE, WATCH_INTERVAL)
 	
 
 if __name__ == '__main__':
 	config = {
-		'npsdb':			None,
+		'npsdb':			[],
 		'smsdb':			'sms.db',
 		'verbose':			0,
 		'skip_prompt':		False,
@@ -134,11 +353,31 @@ if __name__ == '__main__':
 		'dry_run':			False,
 		'skip_ems':			False,
 		'iphone':			False,
+		'state_db':			None,
+		'full_sync':		False,
+		'bulk_dedup':		False,
+		'batch_size':		None,
+		'stats':			False,
+		'stats_json':		None,
+		'profile':			None,
+		'memprofile':		False,
+		'checkpoint':		None,
+		'watch':			False,
+		'watch_interval':	None,
+		'batch':			None,
+		'jobs':				None,
+		'export':			None,
+		'skew':				None,
+		'max_memory':		None,
+		'pipeline':			False,
+		'shards':			None,
+		'defer_triggers':	False,
+		'fast_import':		False,
 	}
 
 	try:
 		def needs_arg(k):
-			return config[k] is None or type(config[k]) is str
+			return config[k] is None or type(config[k]) in (str, list)
 
 		opts, args = getopt.getopt(sys.argv[1:], '', 
 				[k.replace('_', '-') + ("=" if needs_arg(k) else "") 
@@ -155,31 +394,72 @@ if __name__ == '__main__':
 			config[opt] = True
 		elif type(config[opt]) is int:
 			config[opt] = config[opt] + 1
+		elif type(config[opt]) is list:
+			config[opt].append(arg)
 		else:
 			# needs arg
 			config[opt] = arg
 
+	if config['batch'] and config['shards']:
+		print "error: --shards cannot be used with --batch"
+		print_usage()
+		sys.exit(2)
+
+	if config['batch']:
+		failed = run_batch_manifest(config)
+		sys.exit(failed and 1 or 0)
+
 	if not config['country']:
 		print "error: country was not specified"
 		print_usage()
 		sys.exit(2)
 
-	# process NPS filters
-	nps_filters = []
-	nps_filters.append("(TYPE = 'SMS'" + 
-			("" if config['skip_ems'] else " OR TYPE = 'EMS'") + 
-			")")
-	if config['after_date']:
-		nps_filters.append("CREATE_DATE >= #%s#" % (config['after_date']))
+	if config['watch'] and config['iphone']:
+		print "error: --watch cannot be used with --iphone"
+		print_usage()
+		sys.exit(2)
+
+	if config['shards']:
+		for k in ('checkpoint', 'skew', 'max_memory', 'pipeline'):
+			if config[k]:
+				print "error: --shards cannot be used with --" + k.replace('_', '-')
+				print_usage()
+				sys.exit(2)
+
+	try:
+		after_date = parse_after_date(config['after_date'])
+	except ValueError:
+		print "error: invalid date", config['after_date']
+		print_usage()
+		sys.exit(2)
+
+	if config['profile']:
+		import cProfile, atexit
+		profiler = cProfile.Profile()
+		atexit.register(lambda: (profiler.disable(), 
+				profiler.dump_stats(config['profile'])))
+		profiler.enable()
+
+	stats = ImportStats()
+	if config['memprofile']:
+		stats.profile_memory()
+		stats.snapshot('start')
+
+	state_db = config['state_db'] or config['smsdb'] + '-import.db'
 
 	# operate on the device
 	dev = None
 	afc = None
+	resume = False
 	if config['iphone']:
-		# check for existence of sms.db first
+		# check for existence of sms.db first, unless it is that of an 
+		# import interrupted after a checkpoint, which is resumed
 		if os.path.exists(config['smsdb']):
-			raise IOError, "iPhone SMS db already exists at '%s' - will not overwrite." % config['smsdb']
+			resume = import_interrupted(state_db)
+			if not resume:
+				raise IOError, "iPhone SMS db already exists at '%s' - will not overwrite." % config['smsdb']
 
+		import AMDevice
 		dev = AMDevice.MobileDevice()
 		print "waiting for iPhone to be connected...",
 		dev.wait()
@@ -193,73 +473,121 @@ if __name__ == '__main__':
 				print "You need a jailbroken iPhone to access its filesystem"
 				sys.exit(3)
 
-			afc.download_file(IPHONE_SMS_DB, config['smsdb'])
-
-	nps_sms = read_NPS_sms(config['npsdb'], nps_filters)
-	isms = iPhoneSMSDB(config['country'], config['smsdb'])
-
-	count_total		= 0
-	count_empty		= 0
-	count_dup		= 0
-	count_inserted	= 0
-	count_newgrp	= 0
-
-	for s in sorted(nps_sms, key=operator.itemgetter('date')):
-		count_total += 1
+			if resume:
+				print "resuming the interrupted import into", config['smsdb']
+			else:
+				with stats.phase('download'):
+					afc.download_file(IPHONE_SMS_DB, config['smsdb'])
+
+	# every address is normalized once, and shared by all lookups
+	addresses = AddressTable(config['country'])
+
+	if config['export']:
+		import SMSExport
+		isms = iPhoneSMSDB(config['country'], config['smsdb'], None, addresses)
+		count = SMSExport.export_sms(isms, config['export'], stats)
+		isms.close()
+		if config['iphone'] and not resume:
+			os.unlink(config['smsdb'])
 
-		if not s['text'] or not s['text'].strip():
-			count_empty += 1
-			if config['verbose'] >= 2: print "skipping empty SMS", s
-			continue
+		print "exported", count, "SMSes to", config['export']
+		report_stats(stats, config)
+		sys.exit(0)
 
-		if isms.sms_exists(s):
-			if config['verbose'] >= 2: print "duplicate SMS", s
-			count_dup += 1
-		else:
-			if not isms.get_group_id(s['address']):
-				if config['verbose']: print "adding group for", s['address']
-				count_newgrp += 1
-			if config['verbose']: print "inserting SMS", s
-			isms.insert_sms(s)
-			count_inserted += 1
-
-	print
-	print "new groups:\t", count_newgrp
-	print
-	print "empty:\t\t", count_empty
-	print "duplicate:\t", count_dup
-	print "inserted:\t", count_inserted
-	print "TOTAL:\t\t", count_total
-	print
+	max_memory = config['max_memory'] and int(config['max_memory']) * 1048576
+	nps_sources = [open_NPS_source(x, bool(max_memory)) 
+			for x in config['npsdb'] or [None]]
+
+	# dry runs work on an in-memory copy, leaving sms.db untouched
+	isms = iPhoneSMSDB(config['country'], config['smsdb'], state_db, addresses, 
+			in_memory=config['dry_run'])
+
+	if config['fast_import']:
+		isms.begin_fast_import()
+
+	if config['stats'] or config['stats_json']:
+		instrument_import(stats, isms, addresses)
+
+	importer = SMSImporter(isms, nps_sources, stats, 
+			verbose=config['verbose'], 
+			skip_ems=config['skip_ems'], 
+			after_date=after_date, 
+			full_sync=config['full_sync'], 
+			bulk_dedup=config['bulk_dedup'], 
+			batch_size=int(config['batch_size'] or INSERT_BATCH_SIZE), 
+			checkpoint=int(config['checkpoint'] or 0), 
+			dry_run=config['dry_run'], 
+			skew=int(config['skew'] or 0), 
+			max_memory=max_memory, 
+			pipeline=config['pipeline'], 
+			shards=int(config['shards'] or 0), 
+			defer_triggers=config['defer_triggers'])
+
+	if config['watch']:
+		try:
+			watch(importer, config)
+		except KeyboardInterrupt:
+			print "stopped"
+		ok = end_fast_import(isms, config, stats)
+		isms.close()
+		report_stats(stats, config)
+		sys.exit(0 if ok else 1)
+
+	counts = importer.run()
+	print_counts(counts, config, addresses)
+	if max_memory and peak_rss():
+		print "peak memory:\t%.1f MiB (limit %s MiB)" % (peak_rss() / 1048576.0, 
+				config['max_memory'])
+		print
 
 	if config['dry_run']:
 		isms.rollback()
+		end_fast_import(isms, config, stats)
+		report_stats(stats, config)
 		sys.exit(0)
 
 	do_commit = False
-	if isms.dirty:
+	if config['checkpoint']:
+		# already committed at the last checkpoint
+		do_commit = isms.dirty
+		isms.commit()
+		print "committed"
+	elif isms.dirty:
 		do_commit = True
 		if not config['skip_prompt']:
 			do_commit = raw_input("commit? (y/N) ").strip().lower() == 'y'
 
 		if do_commit:
 			print "committing...",
-			isms.commit()
+			with stats.phase('commit'):
+				isms.commit()
 			print "done"
+			stats.snapshot('committed')
 		else:
 			print "not commited"
 			isms.rollback()
 	else:
 		print "no changes"
+		isms.commit()	# only the watermark may have changed
+
+	if not end_fast_import(isms, config, stats):
+		isms.close()
+		if config['iphone']:
+			print "sms.db was not uploaded to the iPhone"
+		sys.exit(1)
 
 	isms.close()
 
-	# upload back to the iphone, or remove unchanged file
+	# upload back to the iphone, or remove unchanged file. A resumed import 
+	# was partly committed before
 	if config['iphone']:
-		if do_commit:
+		if do_commit or resume:
 			print "uploading sms.db to iPhone...",
-			afc.upload_file(config['smsdb'], IPHONE_SMS_DB)
+			with stats.phase('upload'):
+				afc.upload_file(config['smsdb'], IPHONE_SMS_DB)
 			print "done"
 		else:
 			os.unlink(config['smsdb'])
 
+	report_stats(stats, config)
+